@@ -329,6 +329,7 @@ Then Emigo will start by gdb, please send new issue with `emigo-name' buffer con
                            :connection (emigo-epc-connect "127.0.0.1" emigo-epc-port)
                            ))
   (emigo-epc-init-epc-layer emigo-epc-process)
+  (emigo--push-model-config)
 
   (when (and emigo-first-call-method emigo-first-call-args)
     ;; If first call details exist, execute the deferred call
@@ -339,6 +340,27 @@ Then Emigo will start by gdb, please send new issue with `emigo-name' buffer con
       (setq emigo-first-call-method nil)
       (setq emigo-first-call-args nil))))
 
+;; The model settings are cached on the Python side, which is told about
+;; every change instead of asking for them on each prompt.
+(defun emigo--push-model-config (&optional symbol newval)
+  "Send `emigo-model', `emigo-base-url' and `emigo-api-key' to Python.
+If SYMBOL is one of them, NEWVAL is sent as its value."
+  (when (emigo-epc-live-p emigo-epc-process)
+    (cl-flet ((value (var) (if (eq var symbol) newval (default-value var))))
+      (emigo-call-async "emigo_set_emacs_vars"
+                        (value 'emigo-model)
+                        (value 'emigo-base-url)
+                        (value 'emigo-api-key)))))
+
+(defun emigo--model-config-watcher (symbol newval operation where)
+  "Variable watcher pushing global SYMBOL changes to NEWVAL to Python.
+OPERATION and WHERE are as in `add-variable-watcher'."
+  (when (and (eq operation 'set) (null where))
+    (emigo--push-model-config symbol newval)))
+
+(dolist (var '(emigo-model emigo-base-url emigo-api-key))
+  (add-variable-watcher var #'emigo--model-config-watcher))
+
 (defun emigo-enable ()
   (add-hook 'post-command-hook #'emigo-start-process))
 
@@ -746,6 +768,38 @@ TOOL-NAME is provided explicitly when ROLE is 'tool_json'."
             (forward-char (1- (length emigo-prompt-symbol)))
             (emigo-lock-region (point-min) (point))))))))
 
+(defun emigo--flush-buffer-batch (session-path items-json)
+  "Flush a batch of items to the Emigo buffer associated with SESSION-PATH.
+ITEMS-JSON is a JSON array of [CONTENT ROLE TOOL-ID TOOL-NAME] items, see
+`emigo--flush-buffer'.  They are inserted in order, with the buffer's
+change hooks combined into a single call."
+  (let ((items (if (fboundp 'json-parse-string)
+                   (json-parse-string items-json :array-type 'list :null-object nil)
+                 ;; No native JSON before Emacs 27.1
+                 (let ((json-array-type 'list)
+                       (json-null nil))
+                   (json-read-from-string items-json))))
+        (buffer (get-buffer (emigo-get-buffer-name t session-path))))
+    (if (not buffer)
+        ;; Let `emigo--flush-buffer' report the missing buffer
+        (dolist (item items)
+          (apply #'emigo--flush-buffer session-path item))
+      (with-current-buffer buffer
+        ;; `combine-change-calls' is only available from Emacs 27.1
+        (if (fboundp 'combine-change-calls)
+            (combine-change-calls (point-min) (point-max)
+              (dolist (item items)
+                (apply #'emigo--flush-buffer session-path item)))
+          (dolist (item items)
+            (apply #'emigo--flush-buffer session-path item)))))))
+
+(defun emigo--error (session-path msg)
+  "Report error MSG in the echo area and in the Emigo buffer for SESSION-PATH.
+Lets the Python side surface an error with a single call."
+  (message "[Emigo Error] %s" msg)
+  (when (get-buffer (emigo-get-buffer-name t session-path))
+    (emigo--flush-buffer session-path (format "[Error: %s]" msg) "error")))
+
 (defun emigo-lock-region (beg end)
   "Super-lock the region from BEG to END."
   (interactive "r")
@@ -1004,6 +1058,22 @@ If the file is visited in a buffer, offer to revert it."
   (message "[Emigo] Agent finished for session: %s" session-path)
   nil)
 
+(defun emigo--ask-cancel (_session-path active-session token action-desc)
+  "Ask whether to stop the agent running for ACTIVE-SESSION and ACTION-DESC.
+Called from Python when a new request arrives while an interaction is
+still running.  The question is asked from a timer so the Python side
+is not blocked on it; the answer is sent back with TOKEN through
+`emigo_confirm_cancel'."
+  (run-at-time 0 nil
+               (lambda ()
+                 (let ((answer (condition-case nil
+                                   (yes-or-no-p
+                                    (format "Agent is currently running for %s, do you want to stop it and %s? "
+                                            active-session action-desc))
+                                 (quit nil))))
+                   (emigo-call-async "emigo_confirm_cancel" token (if answer t nil)))))
+  nil)
+
 (defun emigo--execute-command-sync (session-path command-string)
   "Execute COMMAND-STRING synchronously in SESSION-PATH and return its output.
 Handles potential errors and captures stdout/stderr."
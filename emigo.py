@@ -38,10 +38,20 @@ import threading
 import traceback
 import subprocess
 import json
+import codecs
 import queue
+import selectors
+import signal
+import logging
+import itertools
+import uuid
+import functools
 import time
 import re
-from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass
+import orjson
+from typing import Callable, Dict, List, Optional, Tuple
 from config import (
     TOOL_DENIED
 )
@@ -53,7 +63,7 @@ from tool_definitions import (
 from epc.server import ThreadingEPCServer
 from utils import (
     init_epc_client, close_epc_client, eval_in_emacs, message_emacs,
-    get_emacs_vars, get_emacs_func_result, _filter_environment_details
+    get_emacs_vars, get_emacs_func_result, _filter_environment_details, logger
 )
 from session import Session
 # Import tool dispatcher
@@ -63,20 +73,170 @@ from tool_definitions import get_tool
 # Import json for displaying parameters during approval
 from typing import Any # Add Any
 
+# Startup and other diagnostic chatter is only written when EMIGO_DEBUG is set.
+_DEBUG = bool(os.environ.get("EMIGO_DEBUG"))
+if _DEBUG:
+    logger.setLevel(logging.DEBUG)
+
+# Messages exchanged with llm_worker.py are framed as a 4-byte little-endian
+# payload length followed by the UTF-8 encoded JSON payload.
+_FRAME_HEADER_SIZE = 4
+
+# Encoder/decoder for the worker protocol. orjson works on UTF-8 bytes directly
+# and emits compact, unescaped JSON; its JSONDecodeError subclasses json's.
+_ENCODE = orjson.dumps
+_DECODE = orjson.loads
+
+# Fast path for the dominant worker message, a plain stream chunk in the key
+# order llm_worker.send_message emits. Anything else, including content using
+# \u or \/ escapes, goes through the full JSON decoder.
+_STREAM_RE = re.compile(
+    rb'\{"type":"stream","session":"([^"\\]+)","role":"([^"\\]*)",'
+    rb'"content":"([^"\\]*(?:\\.[^"\\]*)*)"(?:,"tool_id":"([^"\\]*)")?'
+    rb'(?:,"interaction_id":(\d+))?\}')
+
+# Cancel acknowledgements, as llm_worker writes them. The reader thread answers
+# these itself, since the queue processor may be busy running a tool.
+_CANCEL_ACK_PREFIX = b'{"type":"cancel_ack",'
+
+# @file mentions in a prompt, which add the file to the chat context
+_MENTION_RE = re.compile(r'@(\S+)')
+
+# Streamed LLM output is buffered per (session, role) and flushed to Emacs at
+# most once per display frame, or earlier once enough text has piled up.
+_STREAM_FLUSH_INTERVAL = 0.016 # Seconds
+_STREAM_FLUSH_SIZE = 4096 # Characters
+
+# Sessions kept alive at once (least recently used are evicted), and how long
+# an "is this session path a directory" answer is trusted.
+_MAX_SESSIONS = 32
+_SESSION_DIR_CHECK_TTL = 5.0 # Seconds
+
+# Worker subprocess location, and how long to wait for its "ready" frame.
+_WORKER_SCRIPT = os.path.abspath(os.path.join(os.path.dirname(__file__), "llm_worker.py"))
+_WORKER_CWD = os.path.dirname(_WORKER_SCRIPT)
+_WORKER_READY_TIMEOUT = 120.0 # Seconds; only for a hung worker, imports alone can take a while on a cold start
+_WORKER_RESTART_DELAY = 0.5 # Seconds before replacing a crashed worker; doubles per consecutive crash
+_WORKER_RESTART_MAX_DELAY = 30.0 # Seconds; also how long a worker must run to reset the backoff
+_WORKER_RESTART_ATTEMPTS = 5 # Failed starts after a crash before giving up until the next send
+_WORKER_PIPE_SIZE = 1 << 20 # Bytes requested for the worker's output pipes (Linux only)
+_WORKER_READ_SIZE = 1 << 18 # Bytes per os.read() from a worker pipe
+_WORKER_QUEUE_SIZE = 4096 # Frames waiting for the queue processor
+_COALESCE_LIMIT = 1 << 16 # Bytes; queued stream frames are not grown past this on overflow
+_CANCEL_ACK_TIMEOUT = 0.5 # Seconds to wait for the worker to acknowledge a cancel before restarting it
+
+
+def _log(msg: str):
+    """Writes a line straight to the stderr fd, bypassing sys.stderr's text layer."""
+    data = (msg + "\n").encode("utf-8", "replace")
+    while data:
+        data = data[os.write(2, data):]
+
+
+def _dbg(msg: str):
+    """Writes a diagnostic line to stderr when EMIGO_DEBUG is set."""
+    if _DEBUG:
+        _log(msg)
+
+
+def _parse_stream_frame(payload: bytes) -> Optional[Tuple[str, str, str, Optional[str], Optional[int]]]:
+    """Returns (session, role, content, tool_id, interaction_id) for a plain stream frame, else None."""
+    match = _STREAM_RE.fullmatch(payload)
+    if match is None:
+        return None
+    session, role, content, tool_id, interaction_id = match.groups()
+    if b'\\' in content:
+        # The remaining JSON escapes (\" \\ \b \f \n \r \t) mean the same to escape_decode
+        if b'\\u' in content or b'\\/' in content:
+            return None
+        content = codecs.escape_decode(content)[0]
+    return (session.decode('utf-8'), role.decode('utf-8'), content.decode('utf-8'),
+            None if tool_id is None else tool_id.decode('utf-8'),
+            None if interaction_id is None else int(interaction_id))
+
+
+def _grow_pipe(fd: int):
+    """Raises a pipe's capacity to _WORKER_PIPE_SIZE where the OS allows it."""
+    if not sys.platform.startswith('linux'):
+        return
+    try:
+        import fcntl
+        fcntl.fcntl(fd, getattr(fcntl, "F_SETPIPE_SZ", 1031), _WORKER_PIPE_SIZE)
+    except OSError as e:
+        # /proc/sys/fs/pipe-max-size can cap unprivileged processes; keep the default
+        print(f"Could not raise worker pipe size: {e}", file=sys.stderr)
+
+
+def _write_frames(stream, payloads: List[bytes]):
+    """Writes length-prefixed frames to an unbuffered binary stream in a single write where possible."""
+    view = memoryview(b"".join(part for payload in payloads
+                               for part in (len(payload).to_bytes(_FRAME_HEADER_SIZE, 'little'), payload)))
+    while view:
+        written = stream.write(view)
+        view = view[written:]
+
+
+@dataclass
+class WorkerConfig:
+    """LLM settings for one interaction request; orjson encodes it as an object."""
+    __slots__ = ("model", "api_key", "base_url", "verbose")
+    model: str
+    api_key: Optional[str]
+    base_url: Optional[str]
+    verbose: bool
+
+
+@dataclass
+class RequestData:
+    """Payload of an interaction_request message for llm_worker.py."""
+    __slots__ = ("session_path", "prompt", "history_base_len", "history_delta", "config",
+                 "chat_files", "environment_details", "interaction_id")
+    session_path: str
+    prompt: str
+    history_base_len: int # Leading messages of the worker's copy that are still valid
+    history_delta: List[Dict] # Message dicts the worker lacks
+    config: WorkerConfig
+    chat_files: List[str]
+    environment_details: str
+    interaction_id: int # Lets stale output be told apart after a cancel
+
+
+def _wait_for_exit(proc: subprocess.Popen) -> int:
+    """Blocks until a process exits and returns its exit code.
+
+    Uses a pidfd on Linux, so the wait doesn't hold the Popen's waitpid lock
+    while other threads stop the process.
+    """
+    pidfd_open = getattr(os, "pidfd_open", None)
+    if pidfd_open is not None:
+        try:
+            pidfd = pidfd_open(proc.pid)
+        except OSError:
+            pidfd = None # Already reaped, or the kernel lacks pidfd support
+        if pidfd is not None:
+            try:
+                with selectors.DefaultSelector() as selector:
+                    selector.register(pidfd, selectors.EVENT_READ)
+                    selector.select() # Readable once the process has exited
+            finally:
+                os.close(pidfd)
+    return proc.wait()
+
+
 class Emigo:
     def __init__(self, args):
-        print("Emigo __init__: Starting initialization...", file=sys.stderr, flush=True) # DEBUG + flush
+        _dbg("Emigo __init__: Starting initialization...")
         # Init EPC client port.
-        print(f"Emigo __init__: Received args: {args}", file=sys.stderr, flush=True) # DEBUG + flush
+        _dbg(f"Emigo __init__: Received args: {args}")
         if not args:
             print("Emigo __init__: ERROR - No parameters received (expected EPC port). Exiting.", file=sys.stderr, flush=True)
             sys.exit(1)
         try:
             elisp_epc_port = int(args[0])
-            print(f"Emigo __init__: Attempting to connect to Elisp EPC server on port {elisp_epc_port}...", file=sys.stderr, flush=True) # DEBUG + flush
+            _dbg(f"Emigo __init__: Attempting to connect to Elisp EPC server on port {elisp_epc_port}...")
             # Initialize the EPC client connection to Emacs (utils.py) *before* using it
             init_epc_client(elisp_epc_port)
-            print(f"Emigo __init__: EPC client initialized for Elisp port {elisp_epc_port}", file=sys.stderr, flush=True) # DEBUG + flush
+            _dbg(f"Emigo __init__: EPC client initialized for Elisp port {elisp_epc_port}")
         except (IndexError, ValueError) as e:
             print(f"Emigo __init__: ERROR - Invalid or missing Elisp EPC port argument: {args}. Error: {e}", file=sys.stderr, flush=True) # DEBUG + flush
             sys.exit(1)
@@ -85,26 +245,66 @@ class Emigo:
             sys.exit(1) # Exit if we can't connect back to Emacs
 
         # Init vars.
-        print("Emigo __init__: Initializing internal variables...", file=sys.stderr, flush=True) # DEBUG + flush
+        _dbg("Emigo __init__: Initializing internal variables...")
         # Replace individual state dicts with a single sessions dictionary
-        self.sessions: Dict[str, Session] = {} # Key: session_path, Value: Session object
+        # Key: normalized session path, Value: Session object. Ordered by recent use for LRU eviction.
+        self.sessions: "OrderedDict[str, Session]" = OrderedDict()
+        # Taken only to create or evict sessions; lookups of existing ones don't lock
+        self.sessions_lock = threading.Lock()
+        # (session_path, key, session) of the latest lookup; consecutive EPC calls
+        # nearly always target the same session. Always the most recently used one.
+        self._last_session: Optional[Tuple[str, str, Session]] = None
+        self._session_keys: Dict[str, str] = {} # Raw session_path -> normalized, interned key
+        self._session_dir_checks: Dict[str, Tuple[float, bool]] = {} # Key -> (checked_at, is_dir)
 
         # --- Worker Process Management ---
         self.llm_worker_process: Optional[subprocess.Popen] = None
         self.llm_worker_reader_thread: Optional[threading.Thread] = None
-        self.llm_worker_stderr_thread: Optional[threading.Thread] = None
+        self.llm_worker_writer_thread: Optional[threading.Thread] = None
+        self._send_queue: Optional[queue.SimpleQueue] = None # Outbound messages for the current worker's stdin
+        self.worker_processor_thread: Optional[threading.Thread] = None
         self.llm_worker_lock = threading.Lock()
-        self.worker_output_queue = queue.Queue() # Messages from worker stdout
+        self._worker_crash_streak = 0 # Consecutive worker crashes, for the restart backoff
+        # Frames from worker stdout. Bounded so a flood of output pushes back on the worker
+        # instead of piling up here; see _queue_worker_frame.
+        self.worker_output_queue = queue.Queue(maxsize=_WORKER_QUEUE_SIZE)
+        # Streamed content waiting to be flushed to Emacs, keyed by (session_path, role, tool_id).
+        # Only touched by the worker queue processor thread.
+        self._stream_buffers: Dict[Tuple[str, str, Optional[str]], List[str]] = {}
+        self._stream_buffer_sizes: Dict[Tuple[str, str, Optional[str]], int] = {}
+        self._stream_deadline: Dict[Tuple[str, str, Optional[str]], float] = {}
+        # Flushed output waiting to go to Emacs as one emigo--flush-buffer-batch call per session:
+        # session_path -> [[content, role, tool_id, tool_name], ...]
+        self._emacs_batches: Dict[str, List[List]] = {}
         self.pending_tool_requests: Dict[str, Dict] = {} # {request_id (tool_call_id): original_tool_request_data}
         self.active_interaction_session: Optional[str] = None # Track which session is currently interacting
+        # Claiming and releasing the active interaction are compare-and-set operations under this lock
+        self._active_lock = threading.Lock()
+        # Every interaction request is stamped with a fresh id. Like the worker, the host
+        # drops output of any interaction up to the last cancelled id; an interaction
+        # released early (attempt_completion) still delivers its remaining output.
+        self._interaction_ids = itertools.count(1)
+        self._active_interaction_id: Optional[int] = None
+        self._cancelled_up_to = 0
+        self._cancel_acks: Dict[int, threading.Event] = {} # interaction_id -> set on the worker's cancel_ack
+        # Requests waiting on the user to confirm cancelling the running interaction:
+        # token -> (session_path, prompt, history_override)
+        self._pending_confirmations: Dict[str, Tuple[str, Optional[str], Optional[List]]] = {}
+        # (emigo-model, emigo-base-url, emigo-api-key, valid, error_msg), pushed by Emacs
+        # whenever one changes and validated once then; see _make_model_config
+        self._emacs_vars_cache: Optional[Tuple[str, str, str, bool, Optional[str]]] = None
+        # The worker keeps each session's history between interactions, so only new
+        # messages are sent. session_path -> (history_generation, number of leading
+        # messages of that history the worker holds). Cleared whenever a worker starts.
+        self._worker_history_synced: Dict[str, Tuple[int, int]] = {}
 
         # --- EPC Server Setup ---
-        print("Emigo __init__: Setting up Python EPC server...", file=sys.stderr, flush=True) # DEBUG + flush
+        _dbg("Emigo __init__: Setting up Python EPC server...")
         try:
             self.server = ThreadingEPCServer(('127.0.0.1', 0), log_traceback=True)
             # self.server.logger.setLevel(logging.DEBUG)
             self.server.allow_reuse_address = True
-            print(f"Emigo __init__: Python EPC server created. Will listen on port {self.server.server_address[1]}", file=sys.stderr, flush=True) # DEBUG + flush
+            _dbg(f"Emigo __init__: Python EPC server created. Will listen on port {self.server.server_address[1]}")
         except Exception as e:
             print(f"Emigo __init__: ERROR creating Python EPC server: {e}\n{traceback.format_exc()}", file=sys.stderr, flush=True) # DEBUG + flush
             sys.exit(1)
@@ -116,28 +316,33 @@ class Emigo:
         # self.server.logger.addHandler(ch)
         # self.server.logger = logger # Keep logging setup if needed
 
-        print("Emigo __init__: Registering instance methods with Python EPC server...", file=sys.stderr, flush=True) # DEBUG + flush
+        _dbg("Emigo __init__: Registering instance methods with Python EPC server...")
         self.server.register_instance(self)  # register instance functions let elisp side call
-        print("Emigo __init__: Instance registered with Python EPC server.", file=sys.stderr, flush=True) # DEBUG + flush
+        _dbg("Emigo __init__: Instance registered with Python EPC server.")
 
         # Start Python EPC server with sub-thread.
         try:
-            print("Emigo __init__: Starting Python EPC server thread...", file=sys.stderr, flush=True) # DEBUG + flush
-            self.server_thread = threading.Thread(target=self.server.serve_forever, name="PythonEPCServerThread")
+            _dbg("Emigo __init__: Starting Python EPC server thread...")
+            server_ready = threading.Event()
+
+            def serve():
+                server_ready.set()
+                self.server.serve_forever()
+
+            self.server_thread = threading.Thread(target=serve, name="PythonEPCServerThread")
             self.server_thread.daemon = True # Allow main thread to exit even if this hangs
             self.server_thread.start()
-            # Give the server a moment to bind the port
-            time.sleep(0.1)
-            if not self.server_thread.is_alive():
+            # Wait for the server thread to start serving
+            if not server_ready.wait(timeout=2) or not self.server_thread.is_alive():
                 print("Emigo __init__: ERROR - Python EPC server thread failed to start.", file=sys.stderr, flush=True)
                 sys.exit(1)
-                print(f"Emigo __init__: Python EPC server thread started. Listening on port {self.server.server_address[1]}", file=sys.stderr, flush=True) # DEBUG + flush
+            _dbg(f"Emigo __init__: Python EPC server thread started. Listening on port {self.server.server_address[1]}")
         except Exception as e:
             print(f"Emigo __init__: ERROR starting Python EPC server thread: {e}\n{traceback.format_exc()}", file=sys.stderr, flush=True) # DEBUG + flush
             sys.exit(1) # Exit if server thread fails
 
         # Start the worker process
-        print("Emigo __init__: Starting LLM worker process...", file=sys.stderr, flush=True) # DEBUG + flush
+        _dbg("Emigo __init__: Starting LLM worker process...")
         self._start_llm_worker()
         # Check if worker started successfully
         worker_ok = False
@@ -146,39 +351,31 @@ class Emigo:
                 worker_ok = True
 
         if not worker_ok:
+            # Its stderr was printed by the reader thread; the next send retries the start
             print("Emigo __init__: ERROR - LLM worker process failed to start or exited immediately.", file=sys.stderr, flush=True)
-            # Attempt to read stderr if process object exists
-            if self.llm_worker_process and self.llm_worker_process.stderr:
-                try:
-                    stderr_output = self.llm_worker_process.stderr.read()
-                    print(f"Emigo __init__: Worker stderr upon exit:\n{stderr_output}", file=sys.stderr, flush=True)
-                except Exception as read_err:
-                    print(f"Emigo __init__: Error reading worker stderr after exit: {read_err}", file=sys.stderr, flush=True)
-                    sys.exit(1) # Exit if worker failed
-
-        print("Emigo __init__: LLM worker process started successfully.", file=sys.stderr, flush=True) # DEBUG + flush
-
+        else:
+            _dbg("Emigo __init__: LLM worker process started successfully.")
 
-        self.worker_processor_thread = threading.Thread(target=self._process_worker_queue, name="WorkerQueueProcessorThread", daemon=True)
-        self.worker_processor_thread.start()
+        # The processor outlives individual workers, so start it even without one
+        self._ensure_worker_queue_processor()
         if not self.worker_processor_thread.is_alive():
             print("Emigo __init__: ERROR - Worker queue processor thread failed to start.", file=sys.stderr, flush=True)
-            sys.exit(1)
-            print("Emigo __init__: Worker queue processor thread started.", file=sys.stderr, flush=True) # DEBUG + flush
+        else:
+            _dbg("Emigo __init__: Worker queue processor thread started.")
 
         # Pass Python epc port back to Emacs when first start emigo.
         try:
             python_epc_port = self.server.server_address[1]
-            print(f"Emigo __init__: Sending emigo--first-start signal to Elisp for Python EPC port {python_epc_port}...", file=sys.stderr, flush=True) # DEBUG + flush
+            _dbg(f"Emigo __init__: Sending emigo--first-start signal to Elisp for Python EPC port {python_epc_port}...")
             eval_in_emacs('emigo--first-start', python_epc_port)
-            print(f"Emigo __init__: Sent emigo--first-start signal for port {python_epc_port}", file=sys.stderr, flush=True) # DEBUG + flush
+            _dbg(f"Emigo __init__: Sent emigo--first-start signal for port {python_epc_port}")
         except Exception as e:
             # This might happen if Emacs EPC server isn't ready yet or the connection failed earlier.
             print(f"Emigo __init__: ERROR sending emigo--first-start signal to Elisp: {e}\n{traceback.format_exc()}", file=sys.stderr, flush=True) # DEBUG + flush
             # Don't exit here, maybe the connection will recover, but log clearly.
 
         # Initialization complete. The main thread will likely wait for EPC events or signals.
-        print("Emigo __init__: Initialization sequence complete. Emigo should be running.", file=sys.stderr, flush=True) # DEBUG + flush
+        _dbg("Emigo __init__: Initialization sequence complete. Emigo should be running.")
 
     # --- Worker Process Management ---
 
@@ -189,68 +386,67 @@ class Emigo:
                 print("LLM worker process already running.", file=sys.stderr)
                 return # Already running
 
-            worker_script = os.path.join(os.path.dirname(__file__), "llm_worker.py")
             python_executable = sys.executable # Use the same python interpreter
-            worker_script_path = os.path.abspath(worker_script)
 
             try:
-                print(f"_start_llm_worker: Starting LLM worker process: {python_executable} {worker_script_path}", file=sys.stderr, flush=True) # DEBUG + flush
+                _dbg(f"_start_llm_worker: Starting LLM worker process: {python_executable} {_WORKER_SCRIPT}")
                 self.llm_worker_process = subprocess.Popen(
-                    [python_executable, worker_script_path],
+                    [python_executable, _WORKER_SCRIPT],
                     stdin=subprocess.PIPE,
                     stdout=subprocess.PIPE,
                     stderr=subprocess.PIPE, # Capture stderr
-                    text=True, # Work with text streams
-                    encoding='utf-8', # Ensure UTF-8 for JSON
+                    text=False, # Binary pipes carrying length-prefixed JSON frames
                     bufsize=0, # Use 0 for unbuffered binary mode (stdin/stdout)
-                    # bufsize=1, # Use 1 for line buffered text mode
-                    cwd=os.path.dirname(worker_script_path), # Set CWD to script's directory
+                    cwd=_WORKER_CWD, # Set CWD to script's directory
                     # Use process_group=True on Unix-like systems if needed for cleaner termination
                     # process_group=True if os.name != 'nt' else False
                 )
-                # Brief pause to see if process exits immediately
-                time.sleep(0.5) # Increased sleep time
-                if self.llm_worker_process.poll() is not None:
-                    print(f"_start_llm_worker: ERROR - LLM worker process exited immediately with code {self.llm_worker_process.poll()}.", file=sys.stderr, flush=True)
-                    # Try reading stderr quickly
-                    try:
-                        stderr_output = self.llm_worker_process.stderr.read() if self.llm_worker_process.stderr else "N/A"
-                        print(f"_start_llm_worker: Worker stderr upon exit:\n{stderr_output}", file=sys.stderr, flush=True)
-                    except Exception as read_err:
-                        print(f"_start_llm_worker: Error reading worker stderr after exit: {read_err}", file=sys.stderr, flush=True)
+                proc = self.llm_worker_process
+                _dbg(f"_start_llm_worker: LLM worker started (PID: {proc.pid}).")
+                # Larger pipes mean fewer blocked writes in the worker and bigger reads here
+                _grow_pipe(proc.stdout.fileno())
+                _grow_pipe(proc.stderr.fileno())
+
+                # Create and start the output reader thread *after* process starts.
+                # It also consumes stderr while we wait for the worker's handshake.
+                _dbg("_start_llm_worker: Starting worker output reader thread...")
+                ready = threading.Event()
+                self.llm_worker_reader_thread = threading.Thread(target=self._read_worker_output, args=(proc, ready),
+                                                                 name="WorkerIOReader", daemon=True)
+                self.llm_worker_reader_thread.start()
 
-                    # Regardless of stderr read success, set process to None and notify Emacs
-                    exit_code = self.llm_worker_process.poll() # Get exit code again just in case
+                # The worker sends a "ready" frame once its imports are done. The reader
+                # also sets the event should the worker exit first, so the timeout only
+                # ends the wait for a worker that hangs.
+                if not ready.wait(_WORKER_READY_TIMEOUT) or proc.poll() is not None:
+                    exit_code = proc.poll()
+                    if exit_code is None:
+                        print(f"_start_llm_worker: ERROR - LLM worker not ready after {_WORKER_READY_TIMEOUT}s, terminating it.", file=sys.stderr, flush=True)
+                        proc.kill()
+                        exit_code = proc.wait()
+                    else:
+                        print(f"_start_llm_worker: ERROR - LLM worker process exited immediately with code {exit_code}.", file=sys.stderr, flush=True)
+                    # Its stderr is printed by the reader thread
                     self.llm_worker_process = None
                     message_emacs(f"Error: LLM worker process failed to start (exit code {exit_code}). Check *Messages* or Emigo process buffer.")
                     return # Exit the function
 
-                print(f"_start_llm_worker: LLM worker started (PID: {self.llm_worker_process.pid}).", file=sys.stderr, flush=True)
+                # Outbound messages are queued and written by a dedicated thread
+                _dbg("_start_llm_worker: Starting stdin writer thread...")
+                self._send_queue = queue.SimpleQueue()
+                self.llm_worker_writer_thread = threading.Thread(target=self._write_worker_stdin,
+                                                                 args=(self.llm_worker_process, self._send_queue),
+                                                                 name="WorkerStdinWriter", daemon=True)
+                self.llm_worker_writer_thread.start()
+                # A new worker holds no session history yet
+                self._worker_history_synced.clear()
 
-                # Create and start the stdout reader thread *after* process starts
-                print("_start_llm_worker: Starting stdout reader thread...", file=sys.stderr, flush=True) # DEBUG + flush
-                self.llm_worker_reader_thread = threading.Thread(target=self._read_worker_stdout, name="WorkerStdoutReader", daemon=True)
-                self.llm_worker_reader_thread.start()
-                if not self.llm_worker_reader_thread.is_alive():
-                    print("_start_llm_worker: ERROR - stdout reader thread failed to start.", file=sys.stderr, flush=True)
-                    # Attempt to stop worker if it's running
-                    if self.llm_worker_process and self.llm_worker_process.poll() is None:
-                        self.llm_worker_process.terminate()
-                        self.llm_worker_process = None
-                    return
-
-                print("_start_llm_worker: Starting stderr reader thread...", file=sys.stderr, flush=True) # DEBUG + flush
-                self.llm_worker_stderr_thread = threading.Thread(target=self._read_worker_stderr, name="WorkerStderrReader", daemon=True)
-                self.llm_worker_stderr_thread.start()
-                if not self.llm_worker_stderr_thread.is_alive():
-                    print("_start_llm_worker: ERROR - stderr reader thread failed to start.", file=sys.stderr, flush=True)
-                    # Attempt cleanup
-                    if self.llm_worker_process and self.llm_worker_process.poll() is None:
-                        self.llm_worker_process.terminate()
-                        self.llm_worker_process = None
-                    return
-
-                print("_start_llm_worker: Worker process and reader threads seem to be started.", file=sys.stderr, flush=True) # DEBUG + flush
+                # Handle its output, and replace it should it die on its own
+                self._ensure_worker_queue_processor()
+                threading.Thread(target=self._watch_llm_worker, args=(proc,),
+                                 name="WorkerWatchdog", daemon=True).start()
+
+                _dbg("_start_llm_worker: Worker process and reader threads seem to be started.")
 
             except Exception as e:
                 print(f"_start_llm_worker: Failed to start LLM worker: {e}\n{traceback.format_exc()}", file=sys.stderr, flush=True) # DEBUG + flush
@@ -267,9 +463,20 @@ class Emigo:
             # Should not happen if session_path is validated earlier
             return "<environment_details>\n# Error: Could not get/create session.\n</environment_details>"
 
-    def _stop_llm_worker(self):
-        """Stops the LLM worker subprocess and reader threads."""
+    def _stop_llm_worker(self, expected: Optional[subprocess.Popen] = None) -> bool:
+        """Stops the LLM worker subprocess and reader threads.
+
+        With `expected`, does nothing unless that process is still the current worker.
+        Returns True if the worker was stopped.
+        """
         with self.llm_worker_lock:
+            if expected is not None and self.llm_worker_process is not expected:
+                return False # Stopped or replaced already
+            # Detach and stop the stdin writer before its pipe is closed under it
+            if self._send_queue is not None:
+                self._send_queue.put(None)
+                self._send_queue = None
+
             if self.llm_worker_process:
                 print("Stopping LLM worker process...", file=sys.stderr)
                 if self.llm_worker_process.poll() is None: # Check if still running
@@ -285,247 +492,545 @@ class Emigo:
                     except subprocess.TimeoutExpired:
                         print("LLM worker did not terminate gracefully, killing.", file=sys.stderr)
                         self.llm_worker_process.kill() # Force kill
+                        self.llm_worker_process.wait()
                     except Exception as e:
                         print(f"Error stopping LLM worker: {e}", file=sys.stderr)
-                        self.llm_worker_process = None # Ensure process is marked as None
-                        print("LLM worker process stopped.", file=sys.stderr)
-
-            # Signal and wait for the queue processor thread to finish
-            if hasattr(self, 'worker_processor_thread') and self.worker_processor_thread and self.worker_processor_thread.is_alive():
-                print("Signaling worker queue processor thread to stop...", file=sys.stderr)
-                self.worker_output_queue.put(None) # Signal loop to exit
-                self.worker_processor_thread.join(timeout=2) # Wait for it
-                if self.worker_processor_thread.is_alive():
-                    print("Warning: Worker queue processor thread did not exit cleanly.", file=sys.stderr)
-                    self.worker_processor_thread = None # Mark as stopped
-
-    def _read_worker_stdout(self):
-        """Reads stdout lines from the worker and puts them in a queue."""
-        # Use a loop that checks if the process is alive
-        proc = self.llm_worker_process # Local reference
-        if proc and proc.stdout:
-            try:
-                for line in iter(proc.stdout.readline, ''):
-                    if line:
-                        self.worker_output_queue.put(line.strip())
-                    else:
-                        # Empty string indicates EOF (stream closed)
-                        print("LLM worker stdout stream ended (EOF).", file=sys.stderr)
-                        break
-            except ValueError as e:
-                # Catch ValueError: I/O operation on closed file.
-                print(f"Error reading from LLM worker stdout (stream likely closed): {e}", file=sys.stderr)
-            except Exception as e:
-                # Handle other exceptions during read
-                print(f"Error reading from LLM worker stdout: {e}", file=sys.stderr)
-            finally:
-                # Ensure the sentinel is put even if errors occur or loop finishes
-                print("Signaling end of worker output.", file=sys.stderr)
-                self.worker_output_queue.put(None)
-        else:
-            print("Worker process or stdout not available for reading.", file=sys.stderr)
-            # Still signal end if the thread was started but process died quickly
-            self.worker_output_queue.put(None)
-
-    def _read_worker_stderr(self):
-        """Reads and prints stderr lines from the worker."""
-        # Use a loop that checks if the process is alive
-        proc = self.llm_worker_process # Local reference
-        if proc and proc.stderr:
-            try:
-                for line in iter(proc.stderr.readline, ''):
-                    if line:
-                        # Print worker errors clearly marked
-                        print(f"[WORKER_STDERR] {line.strip()}", file=sys.stderr, flush=True)
-                    else:
-                        # Empty string indicates EOF
-                        print("LLM worker stderr stream ended (EOF).", file=sys.stderr)
-                        break
-            except ValueError as e:
-                # Catch ValueError: I/O operation on closed file.
-                print(f"Error reading from LLM worker stderr (stream likely closed): {e}", file=sys.stderr)
-            except Exception as e:
-                print(f"Error reading from LLM worker stderr: {e}", file=sys.stderr)
+                # Marks the stop as deliberate for the worker's watchdog
+                self.llm_worker_process = None
+                print("LLM worker process stopped.", file=sys.stderr)
+            return True
+
+    def _stop_worker_queue_processor(self):
+        """Stops the worker queue processor thread, which outlives worker restarts."""
+        if self.worker_processor_thread and self.worker_processor_thread.is_alive():
+            print("Signaling worker queue processor thread to stop...", file=sys.stderr)
+            self.worker_output_queue.put(None) # Signal loop to exit
+            self.worker_processor_thread.join(timeout=2) # Wait for it
+            if self.worker_processor_thread.is_alive():
+                # Keep the reference, so no second processor is started next to it
+                print("Warning: Worker queue processor thread did not exit cleanly.", file=sys.stderr)
+
+    def _watch_llm_worker(self, proc: subprocess.Popen):
+        """Waits for a worker to exit and, unless it was stopped on purpose, replaces it."""
+        started_at = time.monotonic()
+        exit_code = _wait_for_exit(proc)
+        if not self._stop_llm_worker(expected=proc):
+            return # Stopped or replaced on purpose
+
+        print(f"LLM worker (PID {proc.pid}) exited unexpectedly with code {exit_code}.", file=sys.stderr)
+        # Whatever it was doing is lost
+        with self._active_lock:
+            session_path = self.active_interaction_session
+            self.active_interaction_session = None
+            self._active_interaction_id = None
+        self.pending_tool_requests.clear()
+
+        # Back off when the worker keeps crashing soon after starting
+        if time.monotonic() - started_at >= _WORKER_RESTART_MAX_DELAY:
+            self._worker_crash_streak = 0
+        for _ in range(_WORKER_RESTART_ATTEMPTS):
+            delay = min(_WORKER_RESTART_DELAY * (2 ** self._worker_crash_streak), _WORKER_RESTART_MAX_DELAY)
+            self._worker_crash_streak += 1
+            notice = f"LLM worker exited unexpectedly (code {exit_code}), restarting it in {delay:g}s."
+            if session_path:
+                # Also shown in the buffer of the interaction it interrupted
+                self._post_error(session_path, notice)
+                session_path = None
+            else:
+                message_emacs(notice)
+            time.sleep(delay)
+            if self.llm_worker_process is not None:
+                return # Restarted meanwhile, e.g. by a send
+            self._start_llm_worker()
+            if self.llm_worker_process is not None:
+                return
+        message_emacs("Error: LLM worker keeps failing to start; it will be retried on the next request.")
+
+    def _read_worker_output(self, proc: subprocess.Popen, ready: threading.Event):
+        """Reads stdout frames and stderr lines from the worker in a single thread.
+
+        `ready` is set when the worker's handshake frame arrives, or when its
+        stdout closes before that.
+        """
+        if not (proc and proc.stdout and proc.stderr):
+            print("Worker process or its output pipes not available for reading.", file=sys.stderr)
+            ready.set()
+            return
+
+        stdout_fd = proc.stdout.fileno()
+        stderr_fd = proc.stderr.fileno()
+        buffers = {stdout_fd: bytearray(), stderr_fd: bytearray()}
+        try:
+            if sys.platform == "win32":
+                # Windows pipes cannot be registered with a selector, so
+                # stderr gets its own blocking reader there.
+                threading.Thread(target=self._pump_worker_pipe, args=(stderr_fd, buffers[stderr_fd], stdout_fd, ready),
+                                 name="WorkerStderrReader", daemon=True).start()
+                self._pump_worker_pipe(stdout_fd, buffers[stdout_fd], stdout_fd, ready)
+            else:
+                # Reads only happen once select() reports data, so blocking reads never stall
+                os.set_blocking(stdout_fd, True)
+                os.set_blocking(stderr_fd, True)
+                with selectors.DefaultSelector() as selector:
+                    selector.register(stdout_fd, selectors.EVENT_READ)
+                    selector.register(stderr_fd, selectors.EVENT_READ)
+                    # The OS only wakes us when one of the pipes has data or hits EOF
+                    while selector.get_map():
+                        for key, _ in selector.select():
+                            if not self._feed_worker_output(key.fd, buffers[key.fd], stdout_fd, ready):
+                                selector.unregister(key.fd)
+        except Exception as e:
+            print(f"Error reading from LLM worker output: {e}", file=sys.stderr)
+        ready.set() # Don't leave _start_llm_worker waiting on a dead worker
+        # The queue processor outlives individual workers; only
+        # _stop_worker_queue_processor posts its stop sentinel.
+        print("LLM worker output reader finished.", file=sys.stderr)
+
+    def _pump_worker_pipe(self, fd: int, buffer: bytearray, stdout_fd: int, ready: threading.Event):
+        """Blocking read loop for a single worker pipe (used where selectors can't watch pipes)."""
+        try:
+            while self._feed_worker_output(fd, buffer, stdout_fd, ready):
+                pass
+        except Exception as e:
+            print(f"Error reading from LLM worker pipe: {e}", file=sys.stderr)
+
+    def _feed_worker_output(self, fd: int, buffer: bytearray, stdout_fd: int, ready: threading.Event) -> bool:
+        """Reads available bytes from a worker pipe and dispatches them. Returns False on EOF."""
+        data = os.read(fd, _WORKER_READ_SIZE) # The GIL is released for the whole read
+        is_stdout = fd == stdout_fd
+        if not data:
+            # Empty bytes indicates EOF (stream closed)
+            print(f"LLM worker {'stdout' if is_stdout else 'stderr'} stream ended (EOF).", file=sys.stderr)
+            if not is_stdout and buffer:
+                print(f"[WORKER_STDERR] {buffer.decode('utf-8', 'replace').strip()}", file=sys.stderr, flush=True)
+            return False
+
+        buffer += data
+        if is_stdout:
+            # Walk every complete [length][payload] frame, then drop them all with one del
+            start = 0
+            end = len(buffer)
+            while end - start >= _FRAME_HEADER_SIZE:
+                payload_start = start + _FRAME_HEADER_SIZE
+                frame_end = payload_start + int.from_bytes(buffer[start:payload_start], 'little')
+                if frame_end > end:
+                    break # Wait for the rest of the payload
+                payload = bytes(buffer[payload_start:frame_end])
+                start = frame_end
+                if not ready.is_set() and _DECODE(payload).get("type") == "ready":
+                    ready.set() # Startup handshake, nothing to dispatch
+                    continue
+                if payload.startswith(_CANCEL_ACK_PREFIX):
+                    acked = self._cancel_acks.get(_DECODE(payload).get("interaction_id"))
+                    if acked is not None:
+                        acked.set()
+                    continue
+                self._queue_worker_frame(payload)
+            if start:
+                del buffer[:start]
         else:
-            print("Worker process or stderr not available for reading.", file=sys.stderr)
+            # Print complete stderr lines, keep any partial line for the next read
+            line_end = buffer.rfind(b'\n')
+            if line_end >= 0:
+                for line in buffer[:line_end].decode('utf-8', 'replace').split('\n'):
+                    # Print worker errors clearly marked
+                    print(f"[WORKER_STDERR] {line.rstrip()}", file=sys.stderr, flush=True)
+                del buffer[:line_end + 1]
+        return True
+
+    def _queue_worker_frame(self, payload: bytes):
+        """Queues a frame for the processor, merging stream chunks into the tail when full."""
+        q = self.worker_output_queue
+        try:
+            q.put_nowait(payload)
+            return
+        except queue.Full:
+            pass
+
+        match = _STREAM_RE.fullmatch(payload)
+        if match is not None:
+            with q.mutex:
+                tail = q.queue[-1] if q.queue else None
+                if isinstance(tail, bytes) and len(tail) < _COALESCE_LIMIT:
+                    tail_match = _STREAM_RE.fullmatch(tail)
+                    # Same session, role, tool_id and interaction: the escaped contents can simply be joined
+                    if tail_match is not None and tail_match.group(1, 2, 4, 5) == match.group(1, 2, 4, 5):
+                        content_end = tail_match.end(3)
+                        q.queue[-1] = tail[:content_end] + match.group(3) + tail[content_end:]
+                        return
+
+        # Wait for the processor to catch up; meanwhile the worker blocks on the full pipe
+        q.put(payload)
+
+    def _send_to_worker(self, data: Dict, on_written: Optional[Callable[[], None]] = None):
+        """Queues a JSON message for the worker's stdin writer thread.
+
+        on_written, if given, is called by the writer once the message is written.
+        """
+        proc = self.llm_worker_process
+        if not proc or proc.poll() is not None:
+            print("Cannot send to worker, process not running. Attempting restart...", file=sys.stderr)
+            self._start_llm_worker() # Try restarting
+            if not self.llm_worker_process:
+                print("Worker restart failed. Cannot send message.", file=sys.stderr)
+                # Notify Emacs about the failure
+                session = data.get("session", "unknown")
+                self._post_buffer_output(session, "[Error: LLM worker process is not running]", "error")
+                return
 
-    def _send_to_worker(self, data: Dict):
-        """Sends a JSON message to the worker's stdin."""
-        with self.llm_worker_lock:
-            if not self.llm_worker_process or self.llm_worker_process.poll() is not None:
-                print("Cannot send to worker, process not running. Attempting restart...", file=sys.stderr)
-                self._start_llm_worker() # Try restarting
-                if not self.llm_worker_process:
-                    print("Worker restart failed. Cannot send message.", file=sys.stderr)
-                    # Notify Emacs about the failure
-                    session = data.get("session", "unknown")
-                    eval_in_emacs("emigo--flush-buffer", session, "[Error: LLM worker process is not running]", "error")
-                    return
+        send_queue = self._send_queue
+        if send_queue is None:
+            # The worker may still be starting, e.g. after a crash; wait for that to finish
+            with self.llm_worker_lock:
+                send_queue = self._send_queue
+        if send_queue is None:
+            print("Cannot send to worker, stdin writer not available.", file=sys.stderr)
+            # Notify Emacs
+            session = data.get("session", "unknown")
+            self._post_buffer_output(session, "[Error: Cannot write to LLM worker process]", "error")
+            return
+        send_queue.put((data, on_written))
 
-            if self.llm_worker_process and self.llm_worker_process.stdin:
+    def _write_worker_stdin(self, proc: subprocess.Popen, send_queue: queue.SimpleQueue):
+        """Writes queued messages to one worker's stdin until told to stop."""
+        while True:
+            data = send_queue.get()
+            if data is None:
+                break # Sentinel from _stop_llm_worker
+            # Take whatever else was queued meanwhile, so it goes out in the same write
+            batch = [data]
+            stopping = False
+            while True:
                 try:
-                    json_str = json.dumps(data) + '\n' # Add newline separator
-                    # print(f"Sending to worker: {json_str.strip()}", file=sys.stderr) # Debug
-                    self.llm_worker_process.stdin.write(json_str)
-                    self.llm_worker_process.stdin.flush()
-                except (OSError, BrokenPipeError, ValueError) as e: # Added ValueError for closed file
-                    print(f"Error sending to LLM worker (Pipe closed or invalid state): {e}", file=sys.stderr)
-                    # Worker has likely crashed or exited. Stop tracking it.
-                    self._stop_llm_worker() # Attempt cleanup, might set self.llm_worker_process to None
-                    # Notify Emacs about the failure
-                    session = data.get("session", "unknown")
-                    eval_in_emacs("emigo--flush-buffer", session, f"[Error: Failed to send message to worker ({e})]", "error")
+                    data = send_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if data is None:
+                    stopping = True
+                    break
+                batch.append(data)
+
+            payloads = []
+            callbacks = []
+            for data, on_written in batch:
+                try:
+                    payloads.append(_ENCODE(data))
                 except Exception as e:
                     print(f"Unexpected error sending to LLM worker: {e}", file=sys.stderr)
                     # Also notify Emacs
                     session = data.get("session", "unknown")
-                    eval_in_emacs("emigo--flush-buffer", session, f"[Error: Unexpected error sending message to worker ({e})]", "error")
-            elif not self.llm_worker_process: # Check if process is None
-                 print("Cannot send to worker, process is not running.", file=sys.stderr)
-                 # Notify Emacs
-                 session = data.get("session", "unknown")
-                 eval_in_emacs("emigo--flush-buffer", session, "[Error: LLM worker process is not running]", "error")
-            else: # Process exists but stdin might be closed
-                 print("Cannot send to worker, stdin not available or closed.", file=sys.stderr)
-                 # Notify Emacs
-                 session = data.get("session", "unknown")
-                 eval_in_emacs("emigo--flush-buffer", session, "[Error: Cannot write to LLM worker process]", "error")
+                    self._post_buffer_output(session, f"[Error: Unexpected error sending message to worker ({e})]", "error")
+                    continue
+                if on_written is not None:
+                    callbacks.append(on_written)
 
+            try:
+                # print(f"Sending {len(payloads)} messages to worker", file=sys.stderr) # Debug
+                _write_frames(proc.stdin, payloads)
+            except (OSError, BrokenPipeError, ValueError) as e: # Added ValueError for closed file
+                if self._send_queue is not send_queue:
+                    break # The worker is being stopped on purpose
+                print(f"Error sending to LLM worker (Pipe closed or invalid state): {e}", file=sys.stderr)
+                # Notify Emacs about the failure
+                session = batch[0][0].get("session", "unknown")
+                self._post_buffer_output(session, f"[Error: Failed to send message to worker ({e})]", "error")
+                # Worker has likely crashed or exited. Replace it so later messages have somewhere to go.
+                self._stop_llm_worker()
+                self._start_llm_worker()
+                break
+            except Exception as e:
+                print(f"Unexpected error sending to LLM worker: {e}", file=sys.stderr)
+                # Also notify Emacs
+                session = batch[0][0].get("session", "unknown")
+                self._post_buffer_output(session, f"[Error: Unexpected error sending message to worker ({e})]", "error")
+            else:
+                for on_written in callbacks:
+                    on_written()
+            if stopping:
+                break
+
+    def _ensure_worker_queue_processor(self):
+        """Starts the worker queue processor thread unless it is already running."""
+        if self.worker_processor_thread and self.worker_processor_thread.is_alive():
+            return
+        self.worker_processor_thread = threading.Thread(target=self._process_worker_queue, name="WorkerQueueProcessorThread", daemon=True)
+        self.worker_processor_thread.start()
 
     def _process_worker_queue(self):
         """Processes messages received from the worker via the queue."""
         while True:
-            line = self.worker_output_queue.get()
-            if line is None:
-                print("Worker output queue processing stopped.", file=sys.stderr)
-                break # Sentinel value received
+            # Sleep until the next frame arrives or the oldest buffered stream chunk is due
+            next_deadline = min(self._stream_deadline.values(), default=None)
+            timeout = None if next_deadline is None else max(0.0, next_deadline - time.monotonic())
+            try:
+                lines = [self.worker_output_queue.get(timeout=timeout)] # Raw frame payloads (bytes)
+            except queue.Empty:
+                self._flush_stream_buffers(due_only=True)
+                self._send_emacs_batches()
+                continue
 
+            # Drain everything already queued so a burst of streamed tokens is
+            # handled in one pass instead of one wakeup per line.
             try:
-                message = json.loads(line)
-                msg_type = message.get("type")
-                session_path = message.get("session")
+                while True:
+                    lines.append(self.worker_output_queue.get_nowait())
+            except queue.Empty:
+                pass
 
-                if not session_path:
-                    print(f"Worker message missing session path: {message}", file=sys.stderr)
-                    continue
+            stop_requested = False
+            for line in lines:
+                if line is None:
+                    stop_requested = True
+                    break # Sentinel value received
 
-                # print(f"Processing worker message: {message}", file=sys.stderr) # Debug
+                try:
+                    stream = _parse_stream_frame(line)
+                    if stream is not None:
+                        session_path, role, content, tool_id, interaction_id = stream
+                        if interaction_id is not None and interaction_id <= self._cancelled_up_to:
+                            continue # Output of a cancelled interaction
+                        session_path = sys.intern(session_path)
+                        # Empty chunks only matter as tool call start markers
+                        if content or role == "tool_json":
+                            self._buffer_stream_chunk(session_path, role, content, tool_id, None)
+                        continue
+
+                    message = _DECODE(line)
+                    msg_type = message.get("type")
+                    interaction_id = message.get("interaction_id")
+
+                    if interaction_id is not None and interaction_id <= self._cancelled_up_to:
+                        continue # Output of a cancelled interaction
+                    session_path = message.get("session")
+                    if session_path:
+                        session_path = sys.intern(session_path)
+
+                    if not session_path:
+                        print(f"Worker message missing session path: {message}", file=sys.stderr)
+                        continue
+
+                    # print(f"Processing worker message: {message}", file=sys.stderr) # Debug
+
+                    if msg_type == "stream":
+                        # Stream payloads always carry role and content (see llm_worker.send_message)
+                        role = message["role"] # e.g., "llm", "user", "tool_json", "tool_json_args"
+                        content = message["content"]
+                        if content or role == "tool_json":
+                            # tool_id is present for tool_json roles, tool_name for tool_json
+                            self._buffer_stream_chunk(session_path, role, content,
+                                                      message.get("tool_id"), message.get("tool_name"))
+                        continue
+
+                    # Any other message (finished, error, tool requests...) must
+                    # see the stream output that preceded it
+                    self._flush_stream_buffers(session_path)
+                    self._send_emacs_batches()
+                    self._handle_worker_message(message, msg_type, session_path)
+                except json.JSONDecodeError:
+                    print(f"Received invalid JSON from worker queue: {line}", file=sys.stderr)
+                except Exception as e:
+                    print(f"Error processing worker queue message: {e}\n{traceback.format_exc()}", file=sys.stderr)
 
-                if msg_type == "stream":
-                    role = message.get("role", "llm") # e.g., "llm", "user", "tool_json", "tool_json_args"
-                    content = message.get("content", "") # Default to empty string
-                    tool_id = message.get("tool_id") # Present for tool_json roles
-                    tool_name = message.get("tool_name") # Present for tool_json role
+            try:
+                self._flush_stream_buffers(due_only=not stop_requested)
+                self._send_emacs_batches()
+            except Exception as e:
+                print(f"Error flushing streamed content to Emacs: {e}\n{traceback.format_exc()}", file=sys.stderr)
 
-                    # Filter content *unless* it's a tool argument chunk
-                    if role != "tool_json_args":
-                        filtered_content = _filter_environment_details(content)
-                    else:
-                        filtered_content = content # Pass tool args unfiltered
-
-                    # Flush to Emacs if content is non-empty OR if it's a tool start marker
-                    if filtered_content or role == "tool_json":
-                        # Pass all relevant info to Elisp
-                        eval_in_emacs("emigo--flush-buffer", session_path, filtered_content, role, tool_id, tool_name)
-                    # History is updated via the 'finished' message
-
-                elif msg_type == "tool_request":
-                    tool_call_id = message.get("request_id") # Worker sends tool_call_id as request_id
-                    tool_name = message.get("tool_name")
-                    parameters_dict = message.get("parameters") # Expect 'parameters' dict
-
-                    if tool_call_id and tool_name and isinstance(parameters_dict, dict):
-                        # Store request data before executing, keyed by tool_call_id
-                        self.pending_tool_requests[tool_call_id] = message
-                        # Execute the tool (handles approval internally)
-                        tool_result_str = self._handle_tool_request_from_worker(session_path, tool_name, parameters_dict)
-                        # Send result back to worker, matching request_id (tool_call_id)
-                        self._send_to_worker({
-                            "type": "tool_result",
-                            "request_id": tool_call_id, # Use the tool_call_id received
-                            "result": tool_result_str # Send the actual result string
-                        })
-                        # Clean up pending request
-                        if tool_call_id in self.pending_tool_requests:
-                            del self.pending_tool_requests[tool_call_id]
-                    else:
-                        print(f"Invalid tool_request from worker: {message}", file=sys.stderr)
-                        # Optionally send an error back to the worker?
-                        if tool_call_id:
-                             self._send_to_worker({
-                                 "type": "tool_result",
-                                 "request_id": tool_call_id,
-                                 "result": tools._format_tool_error("Invalid tool_request message received by main process.")
-                             })
-
-                elif msg_type == "finished":
-                    status = message.get("status", "unknown")
-                    finish_message = message.get("message", "")
-                    print(f"Worker finished interaction for {session_path}. Status: {status}. Message: {finish_message}", file=sys.stderr)
-
-                    # Clear active session *before* processing history or signaling Emacs
-                    if self.active_interaction_session == session_path:
-                        self.active_interaction_session = None # Mark session as no longer active
-                        print(f"Cleared active interaction flag for session: {session_path}", file=sys.stderr) # Debug
-
-                    # Append final assistant message to history here if needed
-                    # If the interaction finished successfully, update the session history
-                    if status in ["success", "max_turns_reached"]:
-                        final_history = message.get("final_history")
-                        if final_history and isinstance(final_history, list):
-                            session = self._get_or_create_session(session_path)
-                            if session:
-                                # Filter history content before setting it
-                                filtered_history = []
-                                for msg in final_history:
-                                    if isinstance(msg, dict) and "content" in msg:
-                                        filtered_msg = dict(msg) # Copy message
-                                        filtered_msg["content"] = _filter_environment_details(msg["content"])
-                                        filtered_history.append(filtered_msg)
-                                    else:
-                                        filtered_history.append(msg) # Keep non-dict or content-less items as is
-
-                                print(f"Updating session history for {session_path} with {len(filtered_history)} filtered messages.", file=sys.stderr)
-                                session.set_history(filtered_history) # Use the filtered history
-                            else:
-                                print(f"Error: Could not find session {session_path} to update history.", file=sys.stderr)
-                        elif status in ["success", "max_turns_reached"]: # Only warn if history was expected
-                            print(f"Warning: Worker finished successfully but did not provide final history for {session_path}.", file=sys.stderr)
-
-                    # Signal Emacs regardless of history update success
-                    eval_in_emacs("emigo--agent-finished", session_path)
-                    # active_interaction_session is now cleared earlier
-
-                elif msg_type == "error":
-                    error_msg = message.get("message", "Unknown error from worker")
-                    print(f"Error from worker ({session_path}): {error_msg}", file=sys.stderr)
-                    eval_in_emacs("emigo--flush-buffer", session_path, f"[Worker Error: {error_msg}]", "error")
-                    # If an error occurs, consider the interaction finished
-                    if self.active_interaction_session == session_path:
-                        self.active_interaction_session = None
-
-                elif msg_type == "get_environment_details_request":
-                    request_id = message.get("request_id")
-                    if request_id:
-                        print(f"Worker requested environment details for {session_path}", file=sys.stderr)
-                        details = self._get_environment_details_string(session_path)
-                        self._send_to_worker({
-                            "type": "get_environment_details_response",
-                            "request_id": request_id,
-                            "session": session_path, # Include session for routing if needed
-                            "details": details
-                        })
-                    else:
-                        print(f"Invalid get_environment_details_request from worker (missing request_id): {message}", file=sys.stderr)
+            if stop_requested:
+                print("Worker output queue processing stopped.", file=sys.stderr)
+                break
 
+    def _buffer_stream_chunk(self, session_path: str, role: str, content: str,
+                             tool_id: Optional[str], tool_name: Optional[str]):
+        """Accumulates a stream chunk until its buffer is due or large enough to flush."""
+        if role in ("tool_json", "tool_json_end"):
+            # Tool call markers go out immediately, after whatever preceded them
+            self._flush_stream_buffers(session_path)
+            self._batch_stream_for_emacs(session_path, role, tool_id, tool_name, [content])
+            return
 
-                # Handle other message types (status, pong, etc.) if needed
-            except json.JSONDecodeError:
-                print(f"Received invalid JSON from worker queue: {line}", file=sys.stderr)
-            except Exception as e:
-                print(f"Error processing worker queue message: {e}\n{traceback.format_exc()}", file=sys.stderr)
+        key = (session_path, role, tool_id)
+        if key not in self._stream_buffers:
+            # Stream output is ordered, so anything buffered for this session
+            # under another role has to reach Emacs first
+            self._flush_stream_buffers(session_path)
+            self._stream_buffers[key] = []
+            self._stream_buffer_sizes[key] = 0
+            self._stream_deadline[key] = time.monotonic() + _STREAM_FLUSH_INTERVAL
+
+        self._stream_buffers[key].append(content)
+        self._stream_buffer_sizes[key] += len(content)
+        if self._stream_buffer_sizes[key] >= _STREAM_FLUSH_SIZE:
+            self._flush_stream_buffer(key)
+
+    def _flush_stream_buffer(self, key: Tuple[str, str, Optional[str]]):
+        """Sends one buffered (session, role, tool_id) run to Emacs and drops the buffer."""
+        contents = self._stream_buffers.pop(key)
+        del self._stream_buffer_sizes[key]
+        del self._stream_deadline[key]
+        session_path, role, tool_id = key
+        self._batch_stream_for_emacs(session_path, role, tool_id, None, contents)
+
+    def _flush_stream_buffers(self, session_path: Optional[str] = None, due_only: bool = False):
+        """Flushes buffered stream output, optionally limited to one session or to due buffers."""
+        now = time.monotonic()
+        for key in list(self._stream_buffers):
+            if session_path is not None and key[0] != session_path:
+                continue
+            if due_only and self._stream_deadline[key] > now:
+                continue
+            self._flush_stream_buffer(key)
+
+    def _batch_stream_for_emacs(self, session_path: str, role: str, tool_id: Optional[str],
+                                tool_name: Optional[str], contents: List[str]):
+        """Adds one run of buffered stream chunks to the session's pending Emacs batch."""
+        content = "".join(contents)
+
+        # Filter content *unless* it's a tool argument chunk
+        if role != "tool_json_args":
+            filtered_content = _filter_environment_details(content)
+        else:
+            filtered_content = content # Pass tool args unfiltered
+
+        # Flush to Emacs if content is non-empty OR if it's a tool start marker
+        if filtered_content or role == "tool_json":
+            # Pass all relevant info to Elisp
+            self._emacs_batches.setdefault(session_path, []).append([filtered_content, role, tool_id, tool_name])
+        # History is updated via the 'finished' message
+
+    def _send_emacs_batches(self):
+        """Sends each session's pending output to Emacs in a single call."""
+        if not self._emacs_batches:
+            return
+        batches = self._emacs_batches
+        self._emacs_batches = {}
+        for session_path, items in batches.items():
+            # Elisp inserts the items in order with change hooks combined
+            eval_in_emacs("emigo--flush-buffer-batch", session_path, _ENCODE(items).decode('utf-8'))
+
+    def _post_buffer_output(self, session_path: str, content: str, role: str):
+        """Routes host-generated buffer output through the queue processor.
 
-    def _handle_tool_request_from_worker(self, session_path: str, tool_name: str, parameters: Dict[str, Any]) -> str:
+        It is then batched with, and ordered after, any stream output already queued
+        for the session.
+        """
+        if not self._post_host_message({"type": "stream", "session": session_path,
+                                        "role": role, "content": content}):
+            eval_in_emacs("emigo--flush-buffer", session_path, content, role)
+
+    def _post_error(self, session_path: str, error_msg: str):
+        """Reports an error in the echo area and the session's buffer, after the output queued before it."""
+        if not self._post_host_message({"type": "host_error", "session": session_path, "message": error_msg}):
+            eval_in_emacs("emigo--error", session_path, error_msg)
+
+    def _post_host_message(self, message: Dict) -> bool:
+        """Queues a host-generated message behind the worker's output. Returns False if it can't be.
+
+        Never blocks, so the caller can fall back to writing to Emacs directly.
+        """
+        processor = self.worker_processor_thread
+        if processor is None or not processor.is_alive():
+            return False
+        try:
+            self.worker_output_queue.put_nowait(_ENCODE(message))
+        except queue.Full:
+            return False
+        return True
+
+    def _handle_worker_message(self, message: Dict, msg_type: Optional[str], session_path: str):
+        """Handles a single non-stream message received from the worker."""
+        if msg_type == "tool_request":
+            tool_call_id = message.get("request_id") # Worker sends tool_call_id as request_id
+            tool_name = message.get("tool_name")
+            parameters_dict = message.get("parameters") # Expect 'parameters' dict
+
+            if tool_call_id and tool_name and isinstance(parameters_dict, dict):
+                # Store request data before executing, keyed by tool_call_id
+                self.pending_tool_requests[tool_call_id] = message
+                # Execute the tool (handles approval internally)
+                tool_result_str = self._handle_tool_request_from_worker(session_path, tool_name, parameters_dict,
+                                                                        message.get("interaction_id"))
+                # Send result back to worker, matching request_id (tool_call_id)
+                self._send_to_worker({
+                    "type": "tool_result",
+                    "request_id": tool_call_id, # Use the tool_call_id received
+                    "result": tool_result_str # Send the actual result string
+                })
+                # Clean up pending request
+                if tool_call_id in self.pending_tool_requests:
+                    del self.pending_tool_requests[tool_call_id]
+            else:
+                print(f"Invalid tool_request from worker: {message}", file=sys.stderr)
+                # Optionally send an error back to the worker?
+                if tool_call_id:
+                     self._send_to_worker({
+                         "type": "tool_result",
+                         "request_id": tool_call_id,
+                         "result": tools._format_tool_error("Invalid tool_request message received by main process.")
+                     })
+
+        elif msg_type == "finished":
+            status = message.get("status", "unknown")
+            finish_message = message.get("message", "")
+            print(f"Worker finished interaction for {session_path}. Status: {status}. Message: {finish_message}", file=sys.stderr)
+
+            # Clear active session *before* processing history or signaling Emacs
+            if self._release_interaction(session_path, message.get("interaction_id")):
+                print(f"Cleared active interaction flag for session: {session_path}", file=sys.stderr) # Debug
+
+            # Append final assistant message to history here if needed
+            # If the interaction finished successfully, update the session history
+            if status in ["success", "max_turns_reached"]:
+                final_history = message.get("final_history")
+                if final_history and isinstance(final_history, list):
+                    session = self._get_or_create_session(session_path)
+                    if session:
+                        print(f"Updating session history for {session_path} with {len(final_history)} messages.", file=sys.stderr)
+                        # The list was decoded from this message and isn't shared, so the
+                        # session may filter and keep its dicts without copying them
+                        # The worker filtered its copy the same way before finishing
+                        self._worker_history_synced[session.session_path] = session.set_history(final_history, copy=False)
+                    else:
+                        print(f"Error: Could not find session {session_path} to update history.", file=sys.stderr)
+                elif status in ["success", "max_turns_reached"]: # Only warn if history was expected
+                    print(f"Warning: Worker finished successfully but did not provide final history for {session_path}.", file=sys.stderr)
+
+            # Signal Emacs regardless of history update success
+            eval_in_emacs("emigo--agent-finished", session_path)
+            # active_interaction_session is now cleared earlier
+
+        elif msg_type == "host_error":
+            # Posted by _post_error, now in order with the session's output
+            eval_in_emacs("emigo--error", session_path, message["message"])
+
+        elif msg_type == "error":
+            error_msg = message.get("message", "Unknown error from worker")
+            print(f"Error from worker ({session_path}): {error_msg}", file=sys.stderr)
+            eval_in_emacs("emigo--flush-buffer", session_path, f"[Worker Error: {error_msg}]", "error")
+            # Resend the whole history next time in case the worker's copy is out of sync
+            self._worker_history_synced.pop(session_path, None)
+            # If an error occurs, consider the interaction finished
+            self._release_interaction(session_path, message.get("interaction_id"))
+
+        elif msg_type == "get_environment_details_request":
+            request_id = message.get("request_id")
+            if request_id:
+                print(f"Worker requested environment details for {session_path}", file=sys.stderr)
+                details = self._get_environment_details_string(session_path)
+                self._send_to_worker({
+                    "type": "get_environment_details_response",
+                    "request_id": request_id,
+                    "session": session_path, # Include session for routing if needed
+                    "details": details
+                })
+            else:
+                print(f"Invalid get_environment_details_request from worker (missing request_id): {message}", file=sys.stderr)
+
+        # Handle other message types (status, pong, etc.) if needed
+
+    def _handle_tool_request_from_worker(self, session_path: str, tool_name: str, parameters: Dict[str, Any],
+                                         interaction_id: Optional[int] = None) -> str:
         """Handles tool execution requested by the worker process."""
         print(f"Handling tool request from worker: {tool_name} for {session_path} with args: {parameters}", file=sys.stderr)
 
@@ -583,9 +1088,8 @@ class Emigo:
         # If the completion tool was called successfully, clear the active session flag *now*
         # so that new prompts aren't rejected while waiting for the worker's 'finished' message.
         if tool_name == TOOL_ATTEMPT_COMPLETION and tool_result == "COMPLETION_SIGNALLED":
-            if self.active_interaction_session == session_path:
-                print(f"Completion signalled for {session_path}. Clearing active session flag immediately.", file=sys.stderr)
-                self.active_interaction_session = None
+            if self._release_interaction(session_path, interaction_id):
+                print(f"Completion signalled for {session_path}. Cleared active session flag immediately.", file=sys.stderr)
             else:
                 # This shouldn't happen if logic is correct, but log if it does
                  print(f"Warning: Completion signalled for {session_path}, but it wasn't the active session ({self.active_interaction_session}).", file=sys.stderr)
@@ -594,34 +1098,117 @@ class Emigo:
 
     # --- Session Management ---
 
+    def _session_key(self, session_path: str) -> str:
+        """Returns the normalized, interned dictionary key for a session path."""
+        key = self._session_keys.get(session_path)
+        if key is None:
+            key = sys.intern(os.path.realpath(session_path))
+            self._session_keys[session_path] = key
+        return key
+
+    def _is_session_dir(self, key: str) -> bool:
+        """Checks that a session path is a directory, caching the answer briefly."""
+        now = time.monotonic()
+        checked = self._session_dir_checks.get(key)
+        if checked is not None and now - checked[0] < _SESSION_DIR_CHECK_TTL:
+            return checked[1]
+        is_dir = os.path.isdir(key)
+        self._session_dir_checks[key] = (now, is_dir)
+        return is_dir
+
     def _get_or_create_session(self, session_path: str) -> Optional[Session]:
         """Gets the Session object for a path, creating it if necessary."""
-        if not os.path.isdir(session_path):
+        last = self._last_session
+        if last is not None and last[0] == session_path and self._is_session_dir(last[1]):
+            return last[2]
+
+        key = self._session_key(session_path)
+        if not self._is_session_dir(key):
             print(f"ERROR: Invalid session path (not a directory): {session_path}", file=sys.stderr)
             # Maybe notify Emacs here?
             eval_in_emacs("message", f"[Emigo Error] Invalid session path: {session_path}")
             return None
 
-        if session_path not in self.sessions:
+        # Fast path: a single dict lookup is atomic under the GIL
+        session = self.sessions.get(key)
+        if session is not None:
+            try:
+                self.sessions.move_to_end(key)
+            except KeyError:
+                session = None # Evicted by another thread meanwhile; take the locked path
+            else:
+                last = (session_path, key, session)
+                self._last_session = last
+                # An eviction between the lookup and the write above would leave an
+                # orphaned session in the slot
+                if self.sessions.get(key) is session:
+                    return session
+                if self._last_session is last:
+                    self._last_session = None
+
+        with self.sessions_lock:
+            # Another thread may have created it while we waited for the lock
+            session = self.sessions.get(key)
+            if session is not None:
+                self.sessions.move_to_end(key)
+                self._last_session = (session_path, key, session)
+                return session
+
             print(f"Creating new session object for: {session_path}", file=sys.stderr)
             # TODO: Get verbose setting from config
-            self.sessions[session_path] = Session(session_path=session_path, verbose=True)
-        return self.sessions[session_path]
+            session = Session(session_path=session_path, verbose=True)
+            self.sessions[key] = session
+
+            # Evict the least recently used sessions, but never the one currently interacting
+            evicted = []
+            while len(self.sessions) > _MAX_SESSIONS:
+                evicted_key, evicted_session = next(iter(self.sessions.items()))
+                if evicted_session.session_path == self.active_interaction_session:
+                    self.sessions.move_to_end(evicted_key)
+                    evicted_key, evicted_session = next(iter(self.sessions.items()))
+                del self.sessions[evicted_key]
+                self._session_dir_checks.pop(evicted_key, None)
+                if self._last_session is not None and self._last_session[2] is evicted_session:
+                    self._last_session = None
+                evicted.append(evicted_session.session_path)
+                print(f"Evicted least recently used session: {evicted_session.session_path}", file=sys.stderr)
+            if evicted:
+                # Drop the path normalizations of everything that is no longer a session
+                for raw_path, raw_key in list(self._session_keys.items()):
+                    if raw_key not in self.sessions:
+                        self._session_keys.pop(raw_path, None)
+            self._last_session = (session_path, key, session)
+
+        for evicted_path in evicted:
+            self._forget_worker_history(evicted_path)
+            message_emacs(f"Closed the least recently used session {evicted_path}; its chat history was dropped.")
+        return session
+
+    def _forget_worker_history(self, session_path: str):
+        """Drops the worker's copy of a session's history."""
+        self._worker_history_synced.pop(session_path, None)
+        send_queue = self._send_queue
+        if send_queue is not None: # A worker that isn't running holds no history
+            send_queue.put(({"type": "forget_session", "session_path": session_path}, None))
 
     # --- EPC Methods Called by Emacs ---
 
     def get_chat_files(self, session_path: str) -> List[str]:
         """EPC: Returns the list of files currently in the chat context for a session."""
+        # Interned paths let dict lookups and == short-circuit on identity
+        session_path = sys.intern(session_path)
         session = self._get_or_create_session(session_path)
         return session.get_chat_files() if session else []
 
     def get_history(self, session_path: str) -> List[Tuple[float, Dict]]:
         """EPC: Retrieves the chat history as list of (timestamp, message_dict) tuples."""
+        session_path = sys.intern(session_path)
         session = self._get_or_create_session(session_path)
         return session.get_history() if session else []
 
     def add_file_to_context(self, session_path: str, filename: str) -> bool:
         """EPC: Adds a specific file to the chat context for a session."""
+        session_path = sys.intern(session_path)
         session = self._get_or_create_session(session_path)
         if not session:
             message_emacs(f"Error: Could not establish session for {session_path}")
@@ -633,6 +1220,7 @@ class Emigo:
 
     def remove_file_from_context(self, session_path: str, filename: str) -> bool:
         """EPC: Removes a specific file from the chat context for a session."""
+        session_path = sys.intern(session_path)
         session = self._get_or_create_session(session_path)
         if not session:
             message_emacs(f"Error: No session found for {session_path}")
@@ -651,229 +1239,288 @@ class Emigo:
             revised_history: A list of message dictionaries representing the
                             new history baseline.
         """
-        print(f"Received revised history for session: {session_path}", file=sys.stderr)
+        session_path = sys.intern(session_path)
+        logger.debug("Received revised history for session: %s", session_path)
 
         if not revised_history:
             message_emacs("[Emigo Error] Received empty revised history.")
             return
 
         # Check for active interaction (similar to emigo_send)
-        if self.active_interaction_session:
-            print(f"Interaction already active for session {self.active_interaction_session}. Asking user about new prompt for {session_path}.", file=sys.stderr)
-            try:
-                confirm_cancel = get_emacs_func_result("yes-or-no-p",
-                                                       "Agent is currently running, do you want to stop it and re-run with the revised history?")
-                if confirm_cancel:
-                    print(f"User confirmed cancellation of {self.active_interaction_session}. Proceeding with revised history for {session_path}.", file=sys.stderr)
-                    if not self.cancel_llm_interaction(self.active_interaction_session):
-                        message_emacs("[Emigo Error] Failed to cancel previous interaction.")
-                        return # Stop if cancellation failed
-                else:
-                    print(f"User declined cancellation. Ignoring revised history for {session_path}.", file=sys.stderr)
-                    eval_in_emacs("message", f"[Emigo] Agent busy with {self.active_interaction_session}. Revised history ignored.")
-                    return
-            except Exception as e:
-                print(f"Error during confirmation/cancellation: {e}\n{traceback.format_exc()}", file=sys.stderr)
-                message_emacs(f"[Emigo Error] Failed to ask for cancellation confirmation: {e}")
-                return
+        active_session, interaction_id = self._claim_interaction(session_path)
+        if active_session is not None:
+            self._ask_cancel(session_path, active_session, None, revised_history)
+            return
 
-        # Mark session as active
-        self.active_interaction_session = session_path
+        self._do_emigo_send(session_path, interaction_id, None, revised_history)
 
-        session = self._get_or_create_session(session_path)
-        if not session:
-            eval_in_emacs("emigo--flush-buffer", f"invalid-session-{session_path}", f"[Error: Invalid session path '{session_path}']", "error")
-            self.active_interaction_session = None # Clear flag on error
-            return
+    def emigo_set_emacs_vars(self, model, base_url, api_key):
+        """EPC: Caches emigo-model, emigo-base-url and emigo-api-key; Emacs calls this when they change."""
+        self._emacs_vars_cache = self._make_model_config(model, base_url, api_key)
 
-        # Convert Elisp plist format (list of lists) to Python list of dicts
-        history_dicts = []
-        if isinstance(revised_history, list):
-            for item in revised_history:
-                if isinstance(item, list) and len(item) == 4 and item[0] == ':role' and item[2] == ':content':
-                    history_dicts.append({'role': item[1], 'content': item[3]})
-                else:
-                    print(f"Warning: Skipping invalid item in revised_history: {item}", file=sys.stderr)
-        else:
-             message_emacs(f"[Emigo Error] Received revised history is not a list: {type(revised_history)}")
-             self.active_interaction_session = None # Clear flag on error
-             return
+    @staticmethod
+    def _make_model_config(model, base_url, api_key) -> Tuple[str, str, str, bool, Optional[str]]:
+        """Validates the model settings, returning them with the validity and an error message."""
+        model, base_url, api_key = model or "", base_url or "", api_key or ""
+        if not isinstance(model, str) or not model.strip():
+            return model, base_url, api_key, False, "Please set emigo-model before starting a session."
+        return model, base_url, api_key, True, None
 
+    def emigo_send(self, session_path: str, prompt: str):
+        """EPC: Handles a user prompt by initiating an interaction with the LLM worker."""
+        session_path = sys.intern(session_path)
+        logger.debug("Received prompt for session: %s: %s", session_path, prompt)
 
-        # Replace the session's history with the *converted* list of dicts
-        print(f"Replacing history for session {session_path} with {len(history_dicts)} revised messages.", file=sys.stderr)
-        session.set_history(history_dicts) # Pass the converted list
+        # Check if another interaction is already running
+        active_session, interaction_id = self._claim_interaction(session_path)
+        if active_session is not None:
+            self._ask_cancel(session_path, active_session, prompt, None)
+            return
 
-        # --- Prepare data for worker ---
-        # The 'prompt' is effectively the last message in the revised history (now dicts)
-        last_message_content = history_dicts[-1].get("content", "") if history_dicts else ""
+        self._do_emigo_send(session_path, interaction_id, prompt)
 
-        # Get current state snapshot (history is now the revised one)
-        session_history = session.get_history() # This now returns the revised history
-        session_chat_files = session.get_chat_files()
-        environment_details_str = session.get_environment_details_string()
+    def _claim_interaction(self, session_path: str) -> Tuple[Optional[str], Optional[int]]:
+        """Makes session_path the active interaction unless one is running.
 
-        # Get model config (same as emigo_send)
-        vars_result = get_emacs_vars(["emigo-model", "emigo-base-url", "emigo-api-key"])
-        if not vars_result or len(vars_result) < 3:
-            message_emacs(f"Error retrieving Emacs variables for session {session_path}.")
+        Returns (None, interaction_id) once claimed, allocating the new interaction's
+        id, otherwise (the session that is interacting, None).
+        """
+        with self._active_lock:
+            active_session = self.active_interaction_session
+            if active_session is not None:
+                return active_session, None
+            self.active_interaction_session = session_path
+            self._active_interaction_id = next(self._interaction_ids)
+            return None, self._active_interaction_id
+
+    def _release_interaction(self, session_path: str, interaction_id: Optional[int] = None) -> bool:
+        """Clears the active interaction if it still belongs to session_path. Returns True if cleared.
+
+        With interaction_id, only clears it if it is still that interaction, so late
+        output of an earlier one can't release a newer claim on the same session.
+        """
+        with self._active_lock:
+            if self.active_interaction_session != session_path:
+                return False
+            if interaction_id is not None and interaction_id != self._active_interaction_id:
+                return False
             self.active_interaction_session = None
-            return
-        model, base_url, api_key = vars_result
+            self._active_interaction_id = None
+            return True
 
-        if not model:
-            message_emacs(f"Please set emigo-model before starting session {session.session_path}.")
-            self.active_interaction_session = None
+    def _ask_cancel(self, session_path: str, active_session: str, prompt: Optional[str],
+                    history_override: Optional[List]):
+        """Asks Emacs whether to cancel the running interaction, without waiting for the answer.
+
+        The request is parked under a token; Emacs answers through emigo_confirm_cancel.
+        """
+        logger.debug("Interaction already active for session %s. Asking user about new request for %s.", active_session, session_path)
+        action_desc = "re-run with your new prompt" if history_override is None else "re-run with the revised history"
+        token = uuid.uuid4().hex
+        self._pending_confirmations[token] = (session_path, prompt, history_override)
+        try:
+            eval_in_emacs("emigo--ask-cancel", session_path, active_session, token, action_desc)
+        except Exception as e:
+            self._pending_confirmations.pop(token, None)
+            logger.exception("Error during confirmation/cancellation: %s", e)
+            message_emacs(f"[Emigo Error] Failed to ask for cancellation confirmation: {e}")
+
+    def emigo_confirm_cancel(self, token: str, answer) -> None:
+        """EPC: Resumes a request that was waiting on the user to confirm cancelling the running agent."""
+        pending = self._pending_confirmations.pop(token, None)
+        if pending is None:
+            logger.debug("Ignoring cancellation answer for unknown token %s.", token)
             return
+        session_path, prompt, history_override = pending
+        what = "New prompt" if history_override is None else "Revised history"
 
-        worker_config = {
-            "model": model,
-            "api_key": api_key if api_key else None,
-            "base_url": base_url if base_url else None,
-            "verbose": session.verbose
-        }
-
-        request_data = {
-            "session_path": session.session_path,
-            "prompt": last_message_content, # Use last message as nominal prompt
-            "history": session_history, # Pass the revised history snapshot
-            "config": worker_config,
-            "chat_files": session_chat_files,
-            "environment_details": environment_details_str,
-        }
-
-       # --- Send request to worker ---
-        print(f"Sending revised interaction request to worker for session {session.session_path}", file=sys.stderr)
-        self._send_to_worker({
-            "type": "interaction_request",
-            "data": request_data
-        })
-        # Response handling happens asynchronously
+        try:
+            if not answer:
+                # User declined, ignore the new request
+                logger.debug("User declined cancellation. Ignoring request for %s.", session_path)
+                active_session = self.active_interaction_session
+                if active_session:
+                    message_emacs(f"Agent busy with {active_session}. {what} ignored.")
+                else:
+                    message_emacs(f"{what} ignored.")
+                return
 
-    def emigo_send(self, session_path: str, prompt: str):
-        """EPC: Handles a user prompt by initiating an interaction with the LLM worker."""
-        print(f"Received prompt for session: {session_path}: {prompt}", file=sys.stderr)
+            # The running interaction may have finished while the user was deciding,
+            # in which case there is nothing left to cancel and the request goes ahead
+            active_session = self.active_interaction_session
+            if active_session:
+                logger.debug("User confirmed cancellation of %s. Proceeding with %s.", active_session, session_path)
+                # Cancel the currently active interaction. This also resets self.active_interaction_session.
+                if self._cancel_interaction(active_session) is False:
+                    return # Stop if cancellation failed; the user has been told why
+        except Exception as e:
+            logger.exception("Error during confirmation/cancellation: %s", e)
+            message_emacs(f"[Emigo Error] Failed to cancel previous interaction: {e}")
+            return
 
-        # Check if another interaction is already running
-        if self.active_interaction_session:
-            print(f"Interaction already active for session {self.active_interaction_session}. Asking user about new prompt for {session_path}.", file=sys.stderr)
-            try:
-                # Ask user in Emacs if they want to cancel the active session and proceed
-                confirm_cancel = get_emacs_func_result("yes-or-no-p",
-                                                       "Agent is currently running, do you want to stop it and re-run with your new prompt?")
-
-                if confirm_cancel:
-                    print(f"User confirmed cancellation of {self.active_interaction_session}. Proceeding with {session_path}.", file=sys.stderr)
-                    # Cancel the currently active interaction. This also resets self.active_interaction_session.
-                    self.cancel_llm_interaction(self.active_interaction_session)
-                else:
-                    # User declined, ignore the new prompt
-                    print(f"User declined cancellation. Ignoring new prompt for {session_path}.", file=sys.stderr)
-                    eval_in_emacs("message", f"[Emigo] Agent busy with {self.active_interaction_session}. New prompt ignored.")
-                    return # Stop processing the new prompt
+        # Another request may have started an interaction in the meantime
+        active_session, interaction_id = self._claim_interaction(session_path)
+        if active_session is not None:
+            self._ask_cancel(session_path, active_session, prompt, history_override)
+            return
+        self._do_emigo_send(session_path, interaction_id, prompt, history_override)
 
-            except Exception as e:
-                print(f"Error during confirmation/cancellation: {e}\n{traceback.format_exc()}", file=sys.stderr)
-                message_emacs(f"[Emigo Error] Failed to ask for cancellation confirmation: {e}")
-                return # Stop processing on error
+    def _do_emigo_send(self, session_path: str, interaction_id: int, prompt: Optional[str],
+                       history_override: Optional[List] = None):
+        """Starts an interaction with the LLM worker for a new prompt, or for a revised history.
 
-        # If we reach here, either no interaction was active, or the user confirmed cancellation.
-        # Mark the *new* session as active.
-        self.active_interaction_session = session_path
+        The caller has claimed the active interaction for session_path as interaction_id.
+        """
 
         # Get or create the session object
         session = self._get_or_create_session(session_path)
         if not session:
-            # Error already logged by _get_or_create_session
-            eval_in_emacs("emigo--flush-buffer", f"invalid-session-{session_path}", f"[Error: Invalid session path '{session_path}']", "error")
+            # Error already logged and reported to Emacs by _get_or_create_session
+            self._release_interaction(session_path, interaction_id) # Clear flag on error
             return
 
-        # Flush the user prompt to the Emacs buffer first
-        eval_in_emacs("emigo--flush-buffer", session.session_path, f"\n\nUser:\n{prompt}\n", "user")
-        # Append user prompt dictionary to the session's history
-        session.append_history({"role": "user", "content": prompt})
-
-        # --- Handle File Mentions (@file) ---
-        mention_pattern = r'@(\S+)'
-        mentioned_files_in_prompt = re.findall(mention_pattern, prompt)
-        # Use the session object's method to add files
-        if mentioned_files_in_prompt:
-            print(f"Found file mentions in prompt: {mentioned_files_in_prompt}", file=sys.stderr)
-            for file in mentioned_files_in_prompt:
-                success, msg = session.add_file_to_context(file)
-                if success:
-                    message_emacs(msg) # Notify Emacs only on successful add
+        # Get model config from Emacs vars, asking Emacs only if it hasn't pushed them yet.
+        # Checked before the history is touched, so nothing is recorded for a prompt
+        # that can't be sent.
+        model_config = self._emacs_vars_cache
+        if model_config is None:
+            vars_result = get_emacs_vars(["emigo-model", "emigo-base-url", "emigo-api-key"])
+            if not vars_result or len(vars_result) < 3:
+                self._post_error(session_path, "Could not retrieve the model settings from Emacs.")
+                self._release_interaction(session_path, interaction_id) # Unset active session
+                return
+            model_config = self._emacs_vars_cache = self._make_model_config(*vars_result[:3])
+        model, base_url, api_key, valid, error_msg = model_config
+        if not valid:
+            self._post_error(session.session_path, error_msg)
+            self._release_interaction(session_path, interaction_id) # Unset active session
+            return
+
+        if history_override is not None:
+            # Convert Elisp plist format (list of lists) to Python list of dicts
+            history_dicts = []
+            if isinstance(history_override, list):
+                for item in history_override:
+                    if isinstance(item, list) and len(item) == 4 and item[0] == ':role' and item[2] == ':content':
+                        history_dicts.append({'role': item[1], 'content': item[3]})
+                    else:
+                        logger.warning("Skipping invalid item in revised_history: %s", item)
+            else:
+                message_emacs(f"[Emigo Error] Received revised history is not a list: {type(history_override)}")
+                self._release_interaction(session_path, interaction_id) # Clear flag on error
+                return
+
+            # Replace the session's history with the *converted* list of dicts
+            logger.debug("Replacing history for session %s with %s revised messages.", session_path, len(history_dicts))
+            session.set_history(history_dicts) # Pass the converted list
+            # The 'prompt' is effectively the last message in the revised history (now dicts)
+            prompt = history_dicts[-1].get("content", "") if history_dicts else ""
+            user_message = None
+        else:
+            # Flush the user prompt to the Emacs buffer first
+            self._post_buffer_output(session.session_path, f"\n\nUser:\n{prompt}\n", "user")
+            # Append user prompt dictionary to the session's history
+            user_message = session.append_history({"role": "user", "content": prompt})
+
+            # --- Handle File Mentions (@file) ---
+            # Most prompts mention no files, so skip the regex unless there is an '@'
+            mentioned_files_in_prompt = _MENTION_RE.findall(prompt) if '@' in prompt else None
+            # Use the session object's method to add files
+            if mentioned_files_in_prompt:
+                logger.debug("Found file mentions in prompt: %s", mentioned_files_in_prompt)
+                for file in mentioned_files_in_prompt:
+                    success, msg = session.add_file_to_context(file)
+                    if success:
+                        message_emacs(msg) # Notify Emacs only on successful add
+
+        # The interaction may have been cancelled before it reached the worker
+        with self._active_lock:
+            still_active = self._active_interaction_id == interaction_id
+        if not still_active:
+            logger.debug("Interaction %s for %s was cancelled before it was sent.", interaction_id, session_path)
+            if user_message is not None:
+                self._pop_user_message(session, user_message) # Unless the cancel removed it already
+            return
 
         # --- Prepare data for worker ---
         # Get current state snapshot from the session object
-        session_history = session.get_history()
+        history_generation, session_history = session.get_history_snapshot()
+        # Only send what the worker doesn't have yet; it keeps the first
+        # history_base_len messages it holds for this session and appends the rest
+        synced = self._worker_history_synced.get(session.session_path)
+        if synced is not None and synced[0] == history_generation and synced[1] <= len(session_history):
+            history_base_len = synced[1]
+        else:
+            history_base_len = 0
         session_chat_files = session.get_chat_files()
         # Generate environment details string using the session object
         environment_details_str = session.get_environment_details_string()
 
-        # Get model config from Emacs vars
-        vars_result = get_emacs_vars(["emigo-model", "emigo-base-url", "emigo-api-key"])
-        if not vars_result or len(vars_result) < 3:
-            message_emacs(f"Error retrieving Emacs variables for session {session_path}.")
-            self.active_interaction_session = None # Unset active session
-            return
-        model, base_url, api_key = vars_result
-
-        if not model:
-            message_emacs(f"Please set emigo-model before starting session {session.session_path}.")
-            self.active_interaction_session = None # Unset active session
-            return
-
-        worker_config = {
-            "model": model,
-            "api_key": api_key if api_key else None,
-            "base_url": base_url if base_url else None,
-            "verbose": session.verbose # Use session's verbose setting
-        }
+        worker_config = WorkerConfig(
+            model=model,
+            api_key=api_key if api_key else None,
+            base_url=base_url if base_url else None,
+            verbose=session.verbose, # Use session's verbose setting
+        )
 
         # Prepare the state snapshot for the worker
-        request_data = {
-            "session_path": session.session_path, # Use absolute path from session
-            "prompt": prompt, # Still useful for context, though history is primary
-            "history": session_history, # Pass history snapshot
-            "config": worker_config,
-            "chat_files": session_chat_files, # Pass chat files snapshot
-            "environment_details": environment_details_str, # Pass generated details
-        }
+        request_data = RequestData(
+            session_path=session.session_path, # Use absolute path from session
+            prompt=prompt, # Still useful for context, though history is primary
+            history_base_len=history_base_len,
+            history_delta=[msg for _, msg in session_history[history_base_len:]],
+            config=worker_config,
+            chat_files=session_chat_files, # Pass chat files snapshot
+            environment_details=environment_details_str, # Pass generated details
+            interaction_id=interaction_id,
+        )
 
         # --- Send request to worker ---
-        print(f"Sending interaction request to worker for session {session.session_path}", file=sys.stderr)
+        logger.debug("Sending interaction request to worker for session %s", session.session_path)
+        # The worker only holds the history once the request has actually been written
         self._send_to_worker({
             "type": "interaction_request",
             "data": request_data
-        })
+        }, on_written=functools.partial(self._worker_history_synced.__setitem__, session.session_path,
+                                        (history_generation, len(session_history))))
         # The response handling happens asynchronously in _process_worker_queue
 
-    def cancel_llm_interaction(self, session_path: str):
-        """Cancels the current LLM interaction by killing and restarting the worker."""
-        print(f"Received request to cancel interaction for session: {session_path}", file=sys.stderr)
-        # Check if the cancellation request is for the currently active session
-        if self.active_interaction_session != session_path:
-            message_emacs(f"No active interaction found for session {session_path} to cancel.")
-            return
-
-        print("Stopping and restarting LLM worker due to cancellation request...", file=sys.stderr)
+    def _cancel_in_worker(self, interaction_id: int) -> bool:
+        """Asks the worker to abandon an interaction. Returns True once it acknowledges."""
+        acked = threading.Event()
+        self._cancel_acks[interaction_id] = acked
+        try:
+            self._send_to_worker({"type": "cancel", "interaction_id": interaction_id})
+            return acked.wait(_CANCEL_ACK_TIMEOUT)
+        finally:
+            self._cancel_acks.pop(interaction_id, None)
+
+    def _pop_user_message(self, session: Session, expected: Optional[Dict] = None) -> bool:
+        """Removes the last user message from a session's history. Returns True if removed."""
+        generation = session.history_generation
+        if not session.pop_last_user_message(expected):
+            return False
+        # The worker's copy still starts with the remaining messages; the next
+        # request truncates it to them via history_base_len
+        synced = self._worker_history_synced.get(session.session_path)
+        if synced is not None and synced[0] == generation:
+            self._worker_history_synced[session.session_path] = (session.history_generation,
+                                                                  min(synced[1], len(session.history)))
+        return True
+
+    def _restart_llm_worker(self) -> bool:
+        """Kills and restarts the worker. Returns True on success."""
+        logger.debug("Stopping and restarting LLM worker...")
         self._stop_llm_worker()
 
-        # Drain the queue to discard messages from the stopped worker
-        print("Draining worker output queue...", file=sys.stderr)
-        drained_count = 0
-        while not self.worker_output_queue.empty():
-            try:
-                _ = self.worker_output_queue.get_nowait()
-                # print(f"Discarding stale message: {stale_msg}", file=sys.stderr) # Optional: very verbose
-                drained_count += 1
-            except queue.Empty:
-                break
-            except Exception as e:
-                print(f"Error draining queue: {e}", file=sys.stderr)
-                break # Stop draining on error
-            print(f"Worker output queue drained ({drained_count} messages discarded).", file=sys.stderr)
+        # Drain the queue to discard messages from the stopped worker, in one go
+        q = self.worker_output_queue
+        with q.mutex:
+            drained_count = len(q.queue)
+            q.queue.clear()
+            q.unfinished_tasks = 0
+            q.not_full.notify_all() # Release any producer blocked on the full queue
+        logger.debug("Worker output queue drained (%s messages discarded).", drained_count)
 
         self._start_llm_worker()
         # Check if worker restart was successful before proceeding
@@ -883,67 +1530,85 @@ class Emigo:
                 worker_restarted_ok = True
 
         if not worker_restarted_ok:
-            print("ERROR: Failed to restart LLM worker after cancellation.", file=sys.stderr)
-            message_emacs("[Emigo Error] Failed to restart LLM worker after cancellation.")
-            # Clear active session state even on failure
-            self.active_interaction_session = None
-            self.pending_tool_requests.clear()
+            logger.error("Failed to restart LLM worker after cancellation.")
             return False # Indicate failure
 
-        print("LLM worker restarted successfully.", file=sys.stderr)
+        logger.debug("LLM worker restarted successfully.")
+        return True
 
-        # --- Restart the worker queue processor thread ---
-        print("Restarting worker queue processor thread...", file=sys.stderr)
-        self.worker_processor_thread = threading.Thread(target=self._process_worker_queue, name="WorkerQueueProcessorThread", daemon=True)
-        self.worker_processor_thread.start()
-        if not self.worker_processor_thread.is_alive():
-            print("ERROR: Failed to restart worker queue processor thread.", file=sys.stderr)
-            message_emacs("[Emigo Error] Failed to restart worker queue processor thread.")
-            # Stop the worker again if the processor fails
-            self._stop_llm_worker()
-            self.active_interaction_session = None
-            self.pending_tool_requests.clear()
-            return False # Indicate failure
-        print("Worker queue processor thread restarted.", file=sys.stderr)
-        # --- End restart queue processor ---
+    def cancel_llm_interaction(self, session_path: str):
+        """EPC: Cancels the current LLM interaction, restarting the worker only if it doesn't acknowledge."""
+        session_path = sys.intern(session_path)
+        logger.debug("Received request to cancel interaction for session: %s", session_path)
+        cancelled = self._cancel_interaction(session_path)
+        if cancelled is None:
+            message_emacs(f"No active interaction found for session {session_path} to cancel.")
+            return False
+        return cancelled
 
+    def _cancel_interaction(self, session_path: str) -> Optional[bool]:
+        """Cancels session_path's interaction if it is the active one.
+
+        Returns True once cancelled, False if that failed (the user has been told why),
+        and None if the session had nothing running.
+        """
+        # Check if the cancellation request is for the currently active session, and
+        # release it in the same step so a concurrent request can't slip in between
+        with self._active_lock:
+            cancelling = self.active_interaction_session == session_path
+            if cancelling:
+                # From here on anything the worker still sends for this interaction is stale
+                interaction_id = self._active_interaction_id
+                self._active_interaction_id = None
+                if interaction_id is not None and interaction_id > self._cancelled_up_to:
+                    self._cancelled_up_to = interaction_id
+                # Clear active session state
+                self.active_interaction_session = None
+        if not cancelling:
+            return None
+        # Clear any pending tool requests that belonged to the cancelled task
+        self.pending_tool_requests.clear()
+
+        if interaction_id is None:
+            logger.debug("No interaction id to cancel in the worker for %s.", session_path)
+        elif self._cancel_in_worker(interaction_id):
+            logger.debug("LLM worker acknowledged cancellation of interaction %s.", interaction_id)
+        else:
+            logger.warning("LLM worker did not acknowledge cancellation within %ss.", _CANCEL_ACK_TIMEOUT)
+            if not self._restart_llm_worker():
+                self._post_error(session_path, "Failed to restart LLM worker after cancellation.")
+                return False # Indicate failure
 
         # Remove the last user message (the cancelled prompt) from history
-        session = self.sessions.get(session_path)
+        session = self.sessions.get(self._session_key(session_path))
         if session and session.history:
-            # History is stored as (timestamp, message_dict)
-            last_timestamp, last_message = session.history[-1]
-            if last_message.get("role") == "user":
-                print(f"Removing cancelled user prompt from history for {session_path}", file=sys.stderr)
-                session.history.pop()
+            if self._pop_user_message(session):
+                logger.debug("Removed cancelled user prompt from history for %s", session_path)
             else:
-                print(f"Warning: Last message in history for cancelled session {session_path} was not from user.", file=sys.stderr)
-
-        # Clear active session state
-        self.active_interaction_session = None
-        # Clear any pending tool requests that belonged to the killed worker's task
-        self.pending_tool_requests.clear()
+                logger.warning("Last message in history for cancelled session %s was not from user.", session_path)
 
         # Invalidate the cache for the cancelled session to ensure fresh context next time
         if session:
-            print(f"Invalidating cache for cancelled session: {session_path}", file=sys.stderr)
+            logger.debug("Invalidating cache for cancelled session: %s", session_path)
             session.invalidate_cache()
         else:
-            print(f"Warning: Could not find session {session_path} to invalidate cache after cancellation.", file=sys.stderr)
+            logger.warning("Could not find session %s to invalidate cache after cancellation.", session_path)
 
         # Notify Emacs buffer
-        eval_in_emacs("emigo--flush-buffer", session_path, "\n[Interaction cancelled by user.]\n", "warning")
+        self._post_buffer_output(session_path, "\n[Interaction cancelled by user.]\n", "warning")
         return True # Indicate success
 
     def cleanup(self):
         """Do some cleanup before exit python process."""
         print("Running Emigo cleanup...", file=sys.stderr)
         self._stop_llm_worker()
+        self._stop_worker_queue_processor()
         close_epc_client()
         print("Emigo cleanup finished.", file=sys.stderr)
 
     def clear_history(self, session_path: str) -> bool:
         """EPC: Clear the chat history for the given session path."""
+        session_path = sys.intern(session_path)
         print(f"Clearing history for session: {session_path}", file=sys.stderr)
         session = self._get_or_create_session(session_path)
         if session:
@@ -958,34 +1623,50 @@ class Emigo:
 
 
 if __name__ == "__main__":
-    print("emigo.py starting execution...", file=sys.stderr, flush=True) # DEBUG + flush
+    _log("emigo.py starting execution...") # DEBUG
     if len(sys.argv) < 2:
-        print("ERROR: Missing EPC server port argument.", file=sys.stderr, flush=True)
+        _log("ERROR: Missing EPC server port argument.")
         sys.exit(1)
     try:
-        print("Initializing Emigo class...", file=sys.stderr, flush=True) # DEBUG + flush
+        _log("Initializing Emigo class...") # DEBUG
         emigo = Emigo(sys.argv[1:])
-        print("Emigo class initialized.", file=sys.stderr, flush=True) # DEBUG + flush
+        _log("Emigo class initialized.") # DEBUG
 
-        # Keep the main thread alive. Instead of joining the server thread (which might exit),
-        # just wait indefinitely or until interrupted.
-        print("Main thread entering wait loop (Ctrl+C to exit)...", file=sys.stderr, flush=True) # DEBUG + flush
-        while True:
-            time.sleep(3600) # Sleep for a long time, wake up periodically if needed
+        # Keep the main thread alive without polling: block on an event that is set
+        # either by a termination signal or by a watchdog when the server thread exits.
+        shutdown_event = threading.Event()
+
+        def _request_shutdown(signum, _frame):
+            _log(f"\nSignal {signum} received, shutting down...")
+            shutdown_event.set()
+
+        signal.signal(signal.SIGTERM, _request_shutdown)
+        signal.signal(signal.SIGINT, _request_shutdown)
+
+        def _watch_server_thread():
+            emigo.server_thread.join()
+            _log("EPC server thread exited, shutting down...")
+            shutdown_event.set()
+
+        threading.Thread(target=_watch_server_thread, name="ServerThreadWatchdog", daemon=True).start()
+
+        _log("Main thread waiting for shutdown (Ctrl+C to exit)...") # DEBUG
+        shutdown_event.wait()
+        emigo.cleanup()
 
     except KeyboardInterrupt:
-        print("\nKeyboardInterrupt received, cleaning up...", file=sys.stderr, flush=True)
+        _log("\nKeyboardInterrupt received, cleaning up...")
         if 'emigo' in locals() and emigo:
             emigo.cleanup()
     except Exception as e:
-        print(f"\nFATAL ERROR in main execution block: {e}", file=sys.stderr, flush=True)
-        print(traceback.format_exc(), file=sys.stderr, flush=True)
+        _log(f"\nFATAL ERROR in main execution block: {e}")
+        _log(traceback.format_exc())
         # Attempt cleanup even on fatal error
         if 'emigo' in locals() and emigo:
             try:
                 emigo.cleanup()
             except Exception as cleanup_err:
-                print(f"Error during cleanup: {cleanup_err}", file=sys.stderr, flush=True)
+                _log(f"Error during cleanup: {cleanup_err}")
                 sys.exit(1) # Exit with error code
     finally:
-        print("emigo.py main execution finished.", file=sys.stderr, flush=True) # DEBUG + flush
+        _log("emigo.py main execution finished.") # DEBUG
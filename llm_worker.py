@@ -10,8 +10,9 @@ Large Language Model (LLM) interactions and agent logic from the main Emigo
 EPC server process.
 
 Key Responsibilities:
-- Listens for interaction requests (including prompt, history, config, context)
-  from `emigo.py` via stdin.
+- Listens for interaction requests (including prompt, new history messages,
+  config, context) from `emigo.py` via stdin, keeping each session's history
+  between requests.
 - Initializes the `LLMClient` (from `llm.py`) and `Agent` (from `agent.py`)
   for each interaction request.
 - Executes the main agentic loop: prepares prompts, calls the LLM, parses
@@ -22,14 +23,29 @@ Key Responsibilities:
 - Sends requests for updated environment details (like file contents or
   repository maps) back to `emigo.py` via stdout and waits for results via stdin.
 - Reports completion status or errors back to `emigo.py` via stdout.
+- Applies cancellation requests from `emigo.py` as soon as they arrive,
+  abandoning the cancelled interaction without restarting the process.
 """
 
 import sys
 import json
 import time
+import orjson
 import traceback
+import threading
+import queue
 import os
 
+# Messages exchanged with emigo.py are framed as a 4-byte little-endian payload
+# length followed by the UTF-8 encoded JSON payload. Keep a private handle on
+# the real stdout for the protocol and point fd 1 at stderr, so stray prints
+# from this process or its libraries cannot corrupt the framing.
+FRAME_HEADER_SIZE = 4
+_protocol_in = sys.stdin.buffer
+_protocol_out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+sys.stdout = sys.stderr
+
 from utils import _filter_environment_details
 from llm import LLMClient
 from agent import Agent
@@ -46,24 +62,76 @@ if project_root not in sys.path:
 
 # --- Communication Functions ---
 
+# Frames are written from the main thread and the stdin reader thread (cancel acks)
+_write_lock = threading.Lock()
+# Requests decoded by the stdin reader thread; None once stdin is closed
+_inbox = queue.SimpleQueue()
+# Interaction being handled by the main thread, and the highest interaction id
+# emigo.py has cancelled. Output for a cancelled interaction is never sent.
+_current_interaction_id = None
+_cancelled_up_to = 0
+# Each session's history as last synced with emigo.py (session_path -> message dicts).
+# Requests only carry the messages added since, see handle_interaction_request.
+_session_histories = {}
+
+
+class InteractionCancelled(BaseException):
+    """Raised in the main thread to unwind an interaction emigo.py has cancelled.
+
+    A BaseException so the agent loop's broad `except Exception` handlers
+    don't swallow it.
+    """
+
+
+def _write_frame(payload: bytes):
+    """Writes one length-prefixed frame to the protocol stdout."""
+    with _write_lock:
+        _protocol_out.write(len(payload).to_bytes(FRAME_HEADER_SIZE, 'little') + payload)
+        _protocol_out.flush()
+
+
+def read_frame():
+    """Reads one length-prefixed frame from stdin. Returns None on EOF."""
+    header = _protocol_in.read(FRAME_HEADER_SIZE)
+    if len(header) < FRAME_HEADER_SIZE:
+        return None
+    size = int.from_bytes(header, 'little')
+    payload = _protocol_in.read(size)
+    if len(payload) < size:
+        return None
+    return payload
+
+
+def check_cancelled():
+    """Raises InteractionCancelled if the current interaction has been cancelled."""
+    if _current_interaction_id is not None and _current_interaction_id <= _cancelled_up_to:
+        raise InteractionCancelled(_current_interaction_id)
+
+
 def send_message(msg_type, session_path, **kwargs):
     """Sends a JSON message to stdout for the main process."""
+    check_cancelled()
+    # Keep "type" and "session" first and "interaction_id" last; orjson's output is
+    # compact and unescaped, so emigo.py can parse stream messages of that exact
+    # shape without a decoder.
     message = {"type": msg_type, "session": session_path, **kwargs}
+    if _current_interaction_id is not None:
+        message["interaction_id"] = _current_interaction_id
     try:
-        print(json.dumps(message), flush=True)
-    except TypeError as e:
+        _write_frame(orjson.dumps(message))
+    except TypeError as e: # orjson.JSONEncodeError is a TypeError
         # Handle potential non-serializable data in kwargs
-        print(json.dumps({
+        _write_frame(orjson.dumps({
             "type": "error",
             "session": session_path,
             "message": f"Serialization error: {e}. Data: {repr(kwargs)}"
-        }), flush=True)
+        }))
     except Exception as e:
-        print(json.dumps({
+        _write_frame(orjson.dumps({
             "type": "error",
             "session": session_path,
             "message": f"Error sending message: {e}"
-        }), flush=True)
+        }))
 
 
 def request_tool_execution(session_path, tool_name, parameters_dict):
@@ -74,17 +142,14 @@ def request_tool_execution(session_path, tool_name, parameters_dict):
     # Wait for the corresponding tool_result from stdin
     while True:
         try:
-            line = sys.stdin.readline()
-            if not line:
+            response = _inbox.get()
+            if response is None:
                 # Main process likely closed stdin, worker should exit
                 send_message("error", session_path, message="Stdin closed unexpectedly. Exiting.")
                 sys.exit(1)
-            response = json.loads(line)
+            check_cancelled() # A cancel also wakes us up here
             if response.get("type") == "tool_result" and response.get("request_id") == request_id:
                 return response.get("result")
-        except json.JSONDecodeError:
-            send_message("error", session_path, message=f"Worker received invalid JSON from stdin: {line.strip()}")
-            # Continue waiting, maybe the next line is valid
         except Exception as e:
             send_message("error", session_path, message=f"Error reading tool result from stdin: {e}")
             # Return an error state to the agent logic
@@ -92,11 +157,24 @@ def request_tool_execution(session_path, tool_name, parameters_dict):
 
 # --- Agent Logic Adaptation ---
 
+def _synced_history(messages):
+    """Returns a finished interaction's history as Session.set_history stores it."""
+    synced = []
+    for msg in messages:
+        if type(msg) is dict and "role" in msg and "content" in msg:
+            content = msg["content"]
+            if content and type(content) is str:
+                msg = {**msg, "content": _filter_environment_details(content)}
+            synced.append(msg)
+    return synced
+
+
 def handle_interaction_request(request):
     """Handles a single interaction request dictionary."""
     session_path = request.get("session_path")
     prompt = request.get("prompt")
-    history = request.get("history", []) # List of (timestamp, message_dict)
+    history_base_len = request.get("history_base_len", 0) # Leading messages of our copy still valid
+    history_delta = request.get("history_delta", []) # Message dicts to append after those
     config = request.get("config", {})
     chat_files_list = request.get("chat_files", [])
     environment_details_str = request.get("environment_details", "<environment_details>\n# Error: Details not provided by main process.\n</environment_details>") # Get details from request
@@ -105,6 +183,13 @@ def handle_interaction_request(request):
         send_message("error", session_path or "unknown", message="Worker received incomplete request.")
         return
 
+    history = _session_histories.get(session_path, [])
+    if history_base_len > len(history):
+        send_message("error", session_path, message=f"Worker holds {len(history)} history messages, request expects {history_base_len}.")
+        return
+    history = history[:history_base_len] + history_delta
+    _session_histories[session_path] = history
+
     # --- Initialize LLM Client ---
     # Get config from request data
     model_name = config.get("model")
@@ -161,8 +246,8 @@ def handle_interaction_request(request):
 
     # --- Run the Agent Interaction Loop ---
     # Keep track of history *during* this interaction locally
-    # Start with a copy of the history received from the main process
-    interaction_history = [msg_dict for _, msg_dict in history] # Extract dicts
+    # Start with a copy of the history synced with the main process
+    interaction_history = list(history)
 
     try:
         # Build system prompt
@@ -514,6 +599,8 @@ def handle_interaction_request(request):
         # Include the final history state unless there was an LLM error
         if status != "llm_error":
             finish_data["final_history"] = interaction_history # Send back the list of dicts
+            # emigo.py replaces the session history with it, so keep the same for next time
+            _session_histories[session_path] = _synced_history(interaction_history)
 
         send_message("finished", session_path, **finish_data)
 
@@ -530,33 +617,72 @@ def handle_interaction_request(request):
 
 # --- Main Worker Loop ---
 
+def read_requests():
+    """Reads requests from stdin into the inbox (runs in its own thread).
+
+    Cancellations are applied and acknowledged right away, even while the
+    main thread is busy streaming from the LLM.
+    """
+    global _cancelled_up_to
+    while True:
+        payload = read_frame()
+        if payload is None:
+            _inbox.put(None) # End of input
+            return
+        try:
+            request = orjson.loads(payload)
+        except json.JSONDecodeError:
+            # Log error but try to continue reading
+            _write_frame(orjson.dumps({"type": "error", "session": "unknown",
+                                       "message": f"Worker received invalid JSON: {payload!r}"}))
+            continue
+
+        if request.get("type") == "cancel":
+            interaction_id = request.get("interaction_id")
+            if isinstance(interaction_id, int) and interaction_id > _cancelled_up_to:
+                _cancelled_up_to = interaction_id
+            _write_frame(orjson.dumps({"type": "cancel_ack", "session": "control",
+                                       "interaction_id": interaction_id}))
+        elif request.get("type") == "forget_session":
+            # The host evicted the session; it resends the full history should it come back
+            _session_histories.pop(request.get("session_path"), None)
+            continue
+        # Cancels are queued too, so a main thread waiting on the inbox wakes up
+        _inbox.put(request)
+
+
 def main():
-    """Reads requests from stdin and handles them."""
-    # Indicate worker is ready (optional)
-    # print(json.dumps({"type": "status", "status": "ready"}), flush=True)
+    """Handles requests from stdin, one at a time."""
+    global _current_interaction_id
+    threading.Thread(target=read_requests, name="StdinReader", daemon=True).start()
+    # Imports are done; tell emigo.py we can take requests
+    send_message("ready", "control")
 
     while True:
         try:
-            line = sys.stdin.readline()
-            if not line:
+            request = _inbox.get()
+            if request is None:
                 # End of input, exit gracefully
-                # print(json.dumps({"type": "status", "status": "exiting", "reason": "stdin closed"}), flush=True)
                 break
 
-            request = json.loads(line)
             if request.get("type") == "interaction_request":
-                handle_interaction_request(request.get("data"))
+                data = request.get("data")
+                _current_interaction_id = data.get("interaction_id") if isinstance(data, dict) else None
+                try:
+                    handle_interaction_request(data)
+                except InteractionCancelled:
+                    print(f"Worker: Interaction {_current_interaction_id} cancelled.", file=sys.stderr)
+                finally:
+                    _current_interaction_id = None
             elif request.get("type") == "ping": # Example control message
                 send_message("pong", request.get("session", "control"))
                 # Handle other control messages if needed (e.g., shutdown)
+            # "cancel" requests were already applied by read_requests
 
-        except json.JSONDecodeError:
-            # Log error but try to continue reading
-             print(json.dumps({"type": "error", "session":"unknown", "message": f"Worker received invalid JSON: {line.strip()}"}), flush=True)
         except Exception as e:
             # Log unexpected errors
             tb_str = traceback.format_exc()
-            print(json.dumps({"type": "error", "session":"unknown", "message": f"Worker main loop error: {e}\n{tb_str}"}), flush=True)
+            send_message("error", "unknown", message=f"Worker main loop error: {e}\n{tb_str}")
             # Depending on the error, might want to break or continue
             time.sleep(1) # Avoid tight loop on persistent error
 
@@ -568,15 +694,13 @@ def request_environment_details(session_path):
     # Wait for the corresponding response from stdin
     while True:
         try:
-            line = sys.stdin.readline()
-            if not line:
+            response = _inbox.get()
+            if response is None:
                 send_message("error", session_path, message="Stdin closed unexpectedly while waiting for env details. Exiting.")
                 sys.exit(1)
-            response = json.loads(line)
+            check_cancelled() # A cancel also wakes us up here
             if response.get("type") == "get_environment_details_response" and response.get("request_id") == request_id:
                 return response.get("details", "") # Return details string or empty
-        except json.JSONDecodeError:
-            send_message("error", session_path, message=f"Worker received invalid JSON from stdin while waiting for env details: {line.strip()}")
         except Exception as e:
             send_message("error", session_path, message=f"Error reading env details result from stdin: {e}")
             return f"<environment_details>\n# Error receiving details: {e}\n</environment_details>" # Return error state
@@ -24,6 +24,8 @@ Key Responsibilities:
 import sys
 import os
 import time
+import threading
+import itertools
 import tiktoken
 from typing import Dict, List, Optional, Tuple
 
@@ -35,13 +37,24 @@ from utils import (
 class Session:
     """Encapsulates the state and operations for a single Emigo session."""
 
+    # Generations are unique across sessions, so a recreated session never reuses one
+    _generations = itertools.count(1)
+
     def __init__(self, session_path: str, verbose: bool = False):
         self.session_path = session_path
         self.verbose = verbose
         self.history: List[Tuple[float, Dict]] = [] # List of (timestamp, message_dict)
+        # Guards history mutations, which come from both the EPC and worker queue threads
+        self._lock = threading.Lock()
+        # Changes whenever history is modified other than by appending
+        self.history_generation = next(Session._generations)
+        # Filtered message content keyed by the content it was filtered from
+        self._filtered_content_cache: Dict[str, str] = {}
         self.chat_files: List[str] = [] # List of relative file paths
-        # Caches for file content, mtimes, and the last generated repomap
-        self.caches: Dict[str, any] = {'mtimes': {}, 'contents': {}, 'last_repomap': None}
+        # Caches for file content, mtimes, the last generated repomap, and the chat files
+        # section of the environment details as ((rel_path, mtime) pairs, text)
+        self.caches: Dict[str, any] = {'mtimes': {}, 'contents': {}, 'last_repomap': None,
+                                       'chat_files_details': None}
         # RepoMapper instance specific to this session
         # TODO: Get map_tokens and tokenizer from config?
         self.repo_mapper = RepoMapper(root_dir=self.session_path, verbose=self.verbose)
@@ -51,21 +64,60 @@ class Session:
 
     def get_history(self) -> List[Tuple[float, Dict]]:
         """Returns the chat history for this session."""
-        return list(self.history) # Return a copy
+        with self._lock:
+            return list(self.history) # Return a copy
+
+    def get_history_snapshot(self) -> Tuple[int, List[Tuple[float, Dict]]]:
+        """Returns the history generation together with a copy of the history."""
+        with self._lock:
+            return self.history_generation, list(self.history)
 
-    def append_history(self, message: Dict):
-        """Appends a message with a timestamp to the history."""
+    def append_history(self, message: Dict) -> Optional[Dict]:
+        """Appends a message with a timestamp to the history. Returns the stored copy."""
         if "role" not in message or "content" not in message:
             print(f"Warning: Attempted to add invalid message to history: {message}", file=sys.stderr)
-            return
-        # Filter content before appending
-        filtered_message = dict(message) # Create a copy
-        filtered_message["content"] = _filter_environment_details(filtered_message["content"])
-        self.history.append((time.time(), filtered_message)) # Store filtered copy
+            return None
+        with self._lock:
+            # Filter content before appending
+            filtered_message = dict(message) # Create a copy
+            filtered_message["content"] = self.filter_content(filtered_message["content"])
+            self.history.append((time.time(), filtered_message)) # Store filtered copy
+        return filtered_message
+
+    def pop_last_user_message(self, expected: Optional[Dict] = None) -> bool:
+        """Removes the last history entry in place if it is a user message. Returns True if removed.
+
+        With `expected`, only removes it if it is that message as returned by append_history.
+        """
+        with self._lock:
+            if self.history and self.history[-1][1].get("role") == "user" and \
+                    (expected is None or self.history[-1][1] is expected):
+                self.history.pop()
+                self.history_generation = next(Session._generations)
+                return True
+            return False
+
+    def filter_content(self, content, previous_cache: Optional[Dict[str, str]] = None):
+        """Filters environment details out of message content, reusing earlier results."""
+        if not isinstance(content, str): # Handle potential non-string content
+            return content
+        cache = self._filtered_content_cache
+        filtered = cache.get(content)
+        if filtered is None and previous_cache is not None:
+            filtered = previous_cache.get(content)
+        if filtered is None:
+            filtered = _filter_environment_details(content)
+        cache[content] = filtered
+        # Filtering is idempotent, so the filtered text maps to itself
+        cache[filtered] = filtered
+        return filtered
 
     def clear_history(self):
         """Clears the chat history for this session."""
-        self.history = []
+        with self._lock:
+            self.history = []
+            self.history_generation = next(Session._generations)
+            self._filtered_content_cache = {}
         # Note: Clearing the Emacs buffer is handled separately by the main process calling Elisp
 
     def get_chat_files(self) -> List[str]:
@@ -187,6 +239,8 @@ class Session:
             # Update cache
             self.caches['mtimes'][rel_path] = current_mtime
             self.caches['contents'][rel_path] = content
+            # Content may have been given without the mtime changing
+            self.caches['chat_files_details'] = None
 
             return True
 
@@ -245,37 +299,54 @@ class Session:
 
         # --- List Added Files and Content ---
         if self.chat_files:
-            details += "# Files Currently in Chat Context\n"
-            # Clean up session cache for files no longer in chat_files list
-            current_chat_files_set = set(self.chat_files)
-            for rel_path in list(self.caches['mtimes'].keys()):
-                if rel_path not in current_chat_files_set:
-                    del self.caches['mtimes'][rel_path]
-                    if rel_path in self.caches['contents']:
-                        del self.caches['contents'][rel_path]
-
-            for rel_path in sorted(self.chat_files): # Sort for consistent order
-                posix_rel_path = rel_path.replace(os.sep, '/')
-                try:
-                    # Get content, updating cache if needed
-                    content = self.get_cached_content(rel_path)
-                    if content is None:
-                        content = f"# Error: Could not read or cache {posix_rel_path}\n"
-
-                    # Use markdown code block for file content
-                    details += f"## File: {posix_rel_path}\n```\n{content}\n```\n\n"
-
-                except Exception as e:
-                    details += f"## File: {posix_rel_path}\n# Error reading file: {e}\n\n"
-                    # Clean up potentially stale cache entries on error
-                    if rel_path in self.caches['mtimes']:
-                        del self.caches['mtimes'][rel_path]
-                    if rel_path in self.caches['contents']:
-                        del self.caches['contents'][rel_path]
+            details += self._get_chat_files_details()
 
         details += "</environment_details>"
         return details
 
+    def _get_chat_files_details(self) -> str:
+        """Returns the environment details section listing chat files and their content.
+
+        The section is reused as long as the chat files and their mtimes are unchanged.
+        """
+        mtime_key = tuple((rel_path, self.repo_mapper.repo_mapper.get_mtime(os.path.join(self.session_path, rel_path)))
+                          for rel_path in sorted(self.chat_files))
+        cached = self.caches['chat_files_details']
+        if cached is not None and cached[0] == mtime_key:
+            return cached[1]
+
+        files_details = "# Files Currently in Chat Context\n"
+        # Clean up session cache for files no longer in chat_files list
+        current_chat_files_set = set(self.chat_files)
+        for rel_path in list(self.caches['mtimes'].keys()):
+            if rel_path not in current_chat_files_set:
+                del self.caches['mtimes'][rel_path]
+                if rel_path in self.caches['contents']:
+                    del self.caches['contents'][rel_path]
+
+        for rel_path in sorted(self.chat_files): # Sort for consistent order
+            posix_rel_path = rel_path.replace(os.sep, '/')
+            try:
+                # Get content, updating cache if needed
+                content = self.get_cached_content(rel_path)
+                if content is None:
+                    content = f"# Error: Could not read or cache {posix_rel_path}\n"
+
+                # Use markdown code block for file content
+                files_details += f"## File: {posix_rel_path}\n```\n{content}\n```\n\n"
+
+            except Exception as e:
+                files_details += f"## File: {posix_rel_path}\n# Error reading file: {e}\n\n"
+                # Clean up potentially stale cache entries on error
+                if rel_path in self.caches['mtimes']:
+                    del self.caches['mtimes'][rel_path]
+                if rel_path in self.caches['contents']:
+                    del self.caches['contents'][rel_path]
+
+        # Stored after reading, as get_cached_content clears it when a file is re-read
+        self.caches['chat_files_details'] = (mtime_key, files_details)
+        return files_details
+
     def set_last_repomap(self, map_content: str):
         """Stores the latest generated repomap content."""
         self.caches['last_repomap'] = map_content
@@ -287,27 +358,43 @@ class Session:
                 del self.caches['mtimes'][rel_path]
             if rel_path in self.caches['contents']:
                 del self.caches['contents'][rel_path]
+            self.caches['chat_files_details'] = None
             if self.verbose:
                 print(f"Invalidated cache for {rel_path}", file=sys.stderr)
         else:
             self.caches['mtimes'].clear()
             self.caches['contents'].clear()
             self.caches['last_repomap'] = None # Also clear repomap if invalidating all
+            self.caches['chat_files_details'] = None
             if self.verbose:
                 print(f"Invalidated all caches for session {self.session_path}", file=sys.stderr)
 
-    def set_history(self, history_dicts: List[Dict]):
-        """Replaces the current history with the provided list of message dictionaries."""
-        self.history = [] # Clear existing history
-        for msg_dict in history_dicts:
-            if "role" in msg_dict and "content" in msg_dict:
-                # Filter content before appending
-                filtered_message = dict(msg_dict) # Create a copy
-                filtered_message["content"] = _filter_environment_details(filtered_message["content"])
-                 # Add with current timestamp, store filtered copy
-                self.history.append((time.time(), filtered_message))
-            else:
-                print(f"Warning: Skipping invalid message dict during set_history: {msg_dict}", file=sys.stderr)
+    def set_history(self, history_dicts: List[Dict], copy: bool = True) -> Tuple[int, int]:
+        """Replaces the current history with the provided list of message dictionaries.
+
+        With copy=False the caller hands over ownership of the dicts, which are
+        filtered in place and stored as they are. Returns the new history
+        generation and the number of messages kept.
+        """
+        with self._lock:
+            self.history = [] # Clear existing history
+            self.history_generation = next(Session._generations)
+            # Start a fresh filter cache so content no longer in the history is evicted
+            previous_cache = self._filtered_content_cache
+            self._filtered_content_cache = {}
+            now = time.time()
+            for msg_dict in history_dicts:
+                if type(msg_dict) is dict and "role" in msg_dict and "content" in msg_dict:
+                    # Filter content before appending
+                    filtered_message = dict(msg_dict) if copy else msg_dict
+                    content = filtered_message["content"]
+                    if content and type(content) is str:
+                        filtered_message["content"] = self.filter_content(content, previous_cache)
+                    # Add with current timestamp, store filtered message
+                    self.history.append((now, filtered_message))
+                else:
+                    print(f"Warning: Skipping invalid message dict during set_history: {msg_dict}", file=sys.stderr)
+            return self.history_generation, len(self.history)
 
 
 # Example usage (for testing if run directly)
@@ -275,9 +275,16 @@ def touch(path):
 
 
 # --- Filtering Helper ---
+# Use re.DOTALL to make '.' match newlines, make it non-greedy
+_ENVIRONMENT_DETAILS_RE = re.compile(r"<environment_details>.*?</environment_details>\s*", re.DOTALL)
+
+
 def _filter_environment_details(text: str) -> str:
     """Removes <environment_details>...</environment_details> blocks from text."""
     if not isinstance(text, str): # Handle potential non-string content
         return text
-    # Use re.DOTALL to make '.' match newlines, make it non-greedy
-    return re.sub(r"<environment_details>.*?</environment_details>\s*", "\n", text, flags=re.DOTALL)
+    # Most text has no such block; a substring scan is cheaper than a regex pass.
+    # Repeated history messages are cached per session by Session.filter_content.
+    if "<environment_details>" not in text:
+        return text
+    return _ENVIRONMENT_DETAILS_RE.sub("\n", text)